@@ -1,23 +1,103 @@
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
 from flask_babel import Babel
-from sqlalchemy.engine import Engine
-from sqlalchemy import event
+from sqlalchemy import event, exc, select
 
 app = Flask(__name__)
 app.config.from_object('config')
 db = SQLAlchemy(app)
 babel = Babel(app)
 
+# value names of the pragmas which read back as numbers, kept per pragma
+# since a name means different things (temp_store MEMORY reads back 2,
+# journal_mode MEMORY reads back memory), the rest read back their name
+BOOLEAN_PRAGMA_VALUES = {'ON': 1, 'OFF': 0, 'TRUE': 1, 'FALSE': 0, 'YES': 1, 'NO': 0}
+PRAGMA_VALUES = {
+    'foreign_keys': BOOLEAN_PRAGMA_VALUES,
+    'recursive_triggers': BOOLEAN_PRAGMA_VALUES,
+    'synchronous': {'OFF': 0, 'NORMAL': 1, 'FULL': 2, 'EXTRA': 3},
+    'temp_store': {'DEFAULT': 0, 'FILE': 1, 'MEMORY': 2},
+    'auto_vacuum': {'NONE': 0, 'FULL': 1, 'INCREMENTAL': 2},
+}
 
-# Activate Sqlite Foreign key constraint
-@event.listens_for(Engine, "connect")
+
+# Activate Sqlite Foreign key constraint and the rest of SQLITE_PRAGMAS,
+# only on the connections of the app's own engine
 def set_sqlite_pragma(dbapi_connection, connection_record):
+    # transactions are begun by begin_sqlite_transaction instead of pysqlite
+    dbapi_connection.isolation_level = None
+
     cursor = dbapi_connection.cursor()
-    cursor.execute("PRAGMA foreign_keys=ON")
+    for name, value in app.config['SQLITE_PRAGMAS']:
+        cursor.execute('PRAGMA {}={}'.format(name, value))
     cursor.close()
 
 
+def begin_sqlite_transaction(conn):
+    """
+    pysqlite only begins a transaction right before the first write, so a
+    transaction which read first fails at once with database is locked when
+    another one wrote in between. Begin explicitly instead, models.write_transaction
+    asks for BEGIN IMMEDIATE to take the write lock up front
+    http://docs.sqlalchemy.org/en/rel_1_0/dialects/sqlite.html#serializable-isolation-savepoints-transactional-ddl
+    """
+    conn.execute('BEGIN ' + conn._execution_options.get('sqlite_begin', 'DEFERRED'))
+
+
+def ping_connection(connection, branch):
+    """
+    Test the pooled connection before it is used, a connection dropped by the
+    database server (restart, failover, idle timeout) is replaced by a new one
+    http://docs.sqlalchemy.org/en/rel_1_0/core/pooling.html#disconnect-handling-pessimistic
+    """
+    if branch:
+        return
+
+    should_close_with_result = connection.should_close_with_result
+    connection.should_close_with_result = False
+    try:
+        connection.scalar(select([1]))
+    except exc.DBAPIError as e:
+        # the pool is invalidated, the retry opens a new connection
+        if e.connection_invalidated:
+            connection.scalar(select([1]))
+        else:
+            raise
+    finally:
+        connection.should_close_with_result = should_close_with_result
+
+
+if db.engine.dialect.name == 'sqlite':
+    event.listen(db.engine, 'connect', set_sqlite_pragma)
+    event.listen(db.engine, 'begin', begin_sqlite_transaction)
+elif app.config.get('SQLALCHEMY_POOL_PRE_PING'):
+    event.listen(db.engine, 'engine_connect', ping_connection)
+
+
+def check_sqlite_pragmas(out=print):
+    """
+    Print the effective value of every SQLITE_PRAGMAS setting and
+    return the names of the ones which differ from the configured value
+    e.g. WAL is not available for in memory databases
+    """
+    if db.engine.dialect.name != 'sqlite':
+        return []
+
+    failed = []
+    with db.engine.connect() as conn:
+        for name, value in app.config['SQLITE_PRAGMAS']:
+            effective = conn.execute('PRAGMA {}'.format(name)).scalar()
+
+            expected = PRAGMA_VALUES.get(name.lower(), {}).get(str(value).upper(), value)
+            same = str(effective).upper() == str(expected).upper()
+            out('{}: {} = {}'.format('ok' if same else 'DIFFERENT', name, effective))
+
+            if not same:
+                failed.append(name)
+
+    return failed
+
+
 from app import views
 from app import models
 from app import jinja_custom_filter
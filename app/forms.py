@@ -1,4 +1,4 @@
-from wtforms import StringField, BooleanField, DateTimeField, \
+from wtforms import StringField, BooleanField, DateTimeField, DateField, \
     SelectField, FieldList, FormField, IntegerField, SubmitField, HiddenField
 from wtforms.widgets import TextArea, HiddenInput
 from . import utils
@@ -12,6 +12,22 @@ from sqlalchemy import func
 from flask import flash
 
 
+# choice lists of the select fields, {table name: (version, choices)},
+# rebuilt when models.CacheVersion of the table changes
+choice_cache = {}
+
+
+def get_cached_choices(table_name, build_choices):
+    version = models.CacheVersion.get_version(table_name)
+    cached = choice_cache.get(table_name)
+    if cached is None or cached[0] != version:
+        cached = (version, build_choices())
+        choice_cache[table_name] = cached
+
+    # copy, callers insert the empty choice
+    return list(cached[1])
+
+
 def int_field_convert_to_none(field):
     """
     Used for select field which has coerce=int
@@ -112,8 +128,8 @@ class ContactForm(Form):
 # Purchase Forms
 # ------------
 def get_item_type_list():
-    return [(i.id, i.item_type)
-            for i in models.ItemType.query.order_by(models.ItemType.item_type)]
+    return get_cached_choices(models.ItemType.__tablename__, lambda: [
+        (i.id, i.item_type) for i in models.ItemType.query.order_by(models.ItemType.item_type)])
     # trying to do query only in models but seems make it complicated
     # list_item_type(list_per_page='ALL',
     #                include_header=False,
@@ -121,7 +137,8 @@ def get_item_type_list():
 
 
 def get_supplier_list():
-    return [(s.id, s.name) for s in models.Supplier.query.order_by(models.Supplier.name)]
+    return get_cached_choices(models.Supplier.__tablename__, lambda: [
+        (s.id, s.name) for s in models.Supplier.query.order_by(models.Supplier.name)])
 
 
 # not derived from Form which is flask-wtforms class
@@ -213,48 +230,33 @@ class PurchaseTransactionForm(Form):
 # Sale Forms
 # ----------
 def get_unsold_items_dict(name_key, stock_key, sold_key):
-    # get unsold items and its quantity
-    unsold_items = db.session.query(models.Item.item_type_id, models.ItemType.item_type,
-                                    func.count(models.Item.id), models.Item.sale_transaction_id) \
-        .join(models.ItemType) \
-        .group_by(models.Item.item_type_id, models.Item.sale_transaction_id)
-
-    # flatten the dict to merge everything based on id, name, stock, sold
-    flattened_sale_dict = {}
-
-    for item in unsold_items:
-        if item[0] not in flattened_sale_dict:
-            # format [name, qty_available, qty_sold]
-            flattened_sale_dict[item[0]] = {name_key: item[1],
-                                            stock_key: 0,
-                                            sold_key: 0}
-
-        # item has been sold because
-        # sale_transaction_id exists
-        # change the total item sold
-        if item[3]:
-            flattened_sale_dict[item[0]][sold_key] = item[2]
-        else:
-            flattened_sale_dict[item[0]][stock_key] = item[2]
+    # stock and sold quantity are kept per item type in the stock summary
+    unsold_items = db.session.query(models.ItemTypeStock.item_type_id,
+                                    models.ItemType.item_type,
+                                    models.ItemTypeStock.stock,
+                                    models.ItemTypeStock.sold) \
+        .join(models.ItemType)
 
-    return flattened_sale_dict
+    return {item[0]: {name_key: item[1], stock_key: item[2], sold_key: item[3]}
+            for item in unsold_items}
 
 
 # compulsory so no None
 def get_customer_list():
-    return [(c.id, c.name) for c in models.Customer.query \
-        .order_by(models.Customer.name)]
+    return get_cached_choices(models.Customer.__tablename__, lambda: [
+        (c.id, c.name) for c in models.Customer.query.order_by(models.Customer.name)])
 
 
 def get_courier_list():
-    list = [(c.id, c.name) for c in models.Courier.query \
-        .order_by(models.Courier.name)]
+    list = get_cached_choices(models.Courier.__tablename__, lambda: [
+        (c.id, c.name) for c in models.Courier.query.order_by(models.Courier.name)])
     list.insert(0, (config.NULL_INTEGER, '---'))
     return list
 
 
 def get_medium_list():
-    list = [(m.id, m.name) for m in models.TransactionMedium.query]
+    list = get_cached_choices(models.TransactionMedium.__tablename__, lambda: [
+        (m.id, m.name) for m in models.TransactionMedium.query])
     list.insert(0, (config.NULL_INTEGER, '---'))
     return list
 
@@ -379,6 +381,8 @@ class FilterTableForm(Form):
     year = StringField(label='Year', validators=[Optional()])
     month = StringField(label='Month', validators=[Optional()])
     day = StringField(label='Day', validators=[Optional()])
+    date_from = DateField(label='From', format='%Y-%m-%d', validators=[Optional()])
+    date_to = DateField(label='To', format='%Y-%m-%d', validators=[Optional()])
     submit_button = SubmitField(label='Filter')
 
     def validate(self, **kwargs):
@@ -399,6 +403,10 @@ class FilterTableForm(Form):
             self.day.errors += ('Day is not valid', 'Check your input format')
             return False
 
+        if self.date_from.data and self.date_to.data and self.date_from.data > self.date_to.data:
+            self.date_to.errors += ('To date is before from date',)
+            return False
+
         return True
 
 
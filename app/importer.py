@@ -0,0 +1,216 @@
+"""
+Streaming importer of historical purchase and sale transactions
+used by `python manage.py import`
+
+Every record (a CSV row or a JSON object per line) is one transaction item:
+    type           purchase or sale
+    ref            transaction reference, consecutive records with the
+                   same type and ref are one transaction
+    date           YYYY-MM-DD HH:MM:SS or YYYY-MM-DD
+    supplier       purchase only
+    customer       sale only
+    item_type      item type name
+    quantity
+    price          purchase price or sale price (each)
+    notes          optional
+    delivery_fee   optional, sale only
+    courier        optional, sale only
+    medium         optional, sale only
+
+Records are committed in chunks of transactions together with the
+last committed line, so a crashed import resumes after that line.
+Sales use FIFO stock, so import the purchases first
+"""
+import csv
+import json
+import os
+import time
+from datetime import datetime
+from app import db, models, utils
+import config
+
+PURCHASE = 'purchase'
+SALE = 'sale'
+DATE_FORMATS = ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d')
+
+
+def read_records(path):
+    """
+    Yield (line number, record dict) from CSV or JSON lines file
+    without loading the whole file
+    """
+    with open(path, newline='') as f:
+        if path.lower().endswith('.csv'):
+            # header is line 1
+            for line_no, record in enumerate(csv.DictReader(f), start=2):
+                yield line_no, record
+        else:
+            for line_no, line in enumerate(f, start=1):
+                if line.strip():
+                    yield line_no, json.loads(line)
+
+
+def group_transactions(records):
+    """
+    Group consecutive records of the same type and ref,
+    yield (last line number, type, list of records)
+    """
+    key = None
+    group = []
+    last_line_no = 0
+
+    for line_no, record in records:
+        record_key = (record.get('type', '').strip().lower(), record.get('ref') or line_no)
+
+        if group and record_key != key:
+            yield last_line_no, key[0], group
+            group = []
+
+        key = record_key
+        group.append(record)
+        last_line_no = line_no
+
+    if group:
+        yield last_line_no, key[0], group
+
+
+def parse_date(text):
+    for date_format in DATE_FORMATS:
+        try:
+            return datetime.strptime(text.strip(), date_format)
+        except ValueError:
+            pass
+    raise ValueError('Invalid date: {}'.format(text))
+
+
+def optional_int(value):
+    return int(value) if value not in (None, '') else None
+
+
+class NameMap(object):
+    """
+    In memory name -> id map of a model, loaded once per import,
+    missing names are added to the database on first use
+    """
+
+    def __init__(self, model, column, normalise=utils.remove_multi_spaces):
+        self.model = model
+        self.column = column
+        self.normalise = normalise
+        self.ids = {normalise(name): id for id, name in
+                    db.session.query(model.id, column)}
+
+    def get(self, name):
+        if not name or not name.strip():
+            return None
+
+        name = self.normalise(name)
+        if name not in self.ids:
+            new = self.model(**{self.column.key: name})
+            db.session.add(new)
+            db.session.flush()
+            self.ids[name] = new.id
+
+        return self.ids[name]
+
+
+class Importer(object):
+
+    def __init__(self, chunk_size=config.IMPORT_CHUNK_SIZE, out=print):
+        self.chunk_size = chunk_size
+        self.out = out
+
+        self.item_types = NameMap(models.ItemType, models.ItemType.item_type,
+                                  models.ItemType.format_item_type)
+        self.suppliers = NameMap(models.Supplier, models.Supplier.name)
+        self.customers = NameMap(models.Customer, models.Customer.name)
+        self.couriers = NameMap(models.Courier, models.Courier.name)
+        self.mediums = NameMap(models.TransactionMedium, models.TransactionMedium.name)
+
+    def add_purchase(self, records):
+        first = records[0]
+        trans = models.PurchaseTransaction(transaction_date=parse_date(first['date']),
+                                           supplier_id=self.suppliers.get(first['supplier']),
+                                           notes=first.get('notes') or None)
+        db.session.add(trans)
+        db.session.flush()
+
+        items = [{'purchase_price': int(r['price']),
+                  'item_type_id': self.item_types.get(r['item_type']),
+                  'quantity': int(r['quantity'])}
+                 for r in records]
+
+        if not models.PurchaseTransaction.try_add_purchase_items(trans.id, items):
+            raise ValueError(models.PurchaseTransaction.error)
+
+        return sum(x['quantity'] for x in items)
+
+    def add_sale(self, records):
+        first = records[0]
+        trans = models.SaleTransaction(transaction_date=parse_date(first['date']),
+                                       customer_id=self.customers.get(first['customer']),
+                                       courier_id=self.couriers.get(first.get('courier')),
+                                       delivery_fee=optional_int(first.get('delivery_fee')),
+                                       transaction_medium_id=self.mediums.get(first.get('medium')),
+                                       notes=first.get('notes') or None)
+        db.session.add(trans)
+        db.session.flush()
+
+        items = [{'sale_price': int(r['price']),
+                  'item_type_id': self.item_types.get(r['item_type']),
+                  'quantity': int(r['quantity'])}
+                 for r in records]
+
+        if not models.SaleTransaction.try_add_sale_items(trans.id, items):
+            raise ValueError(models.SaleTransaction.error)
+
+        return sum(x['quantity'] for x in items)
+
+    def import_file(self, path):
+        source = os.path.abspath(path)
+        checkpoint = models.ImportCheckpoint.query.filter_by(source=source).first()
+        if checkpoint is None:
+            checkpoint = models.ImportCheckpoint(source=source, line=0)
+        elif checkpoint.line:
+            self.out('{}: resuming after line {}'.format(path, checkpoint.line))
+
+        resume_line = checkpoint.line
+        records = ((n, r) for n, r in read_records(path) if n > resume_line)
+
+        started = time.time()
+        transactions = units = pending = 0
+
+        for line_no, kind, group in group_transactions(records):
+            try:
+                if kind == PURCHASE:
+                    units += self.add_purchase(group)
+                elif kind == SALE:
+                    units += self.add_sale(group)
+                else:
+                    raise ValueError('Unknown transaction type: {}'.format(kind))
+            except Exception as e:
+                db.session.rollback()
+                raise ValueError('{} line {}: {}'.format(path, line_no, e))
+
+            transactions += 1
+            pending += 1
+            checkpoint.line = line_no
+
+            if pending >= self.chunk_size:
+                self.commit(path, checkpoint, transactions, units, started)
+                pending = 0
+
+        if pending:
+            self.commit(path, checkpoint, transactions, units, started)
+
+        return transactions, units
+
+    def commit(self, path, checkpoint, transactions, units, started):
+        # checkpoint is committed with the chunk so both succeed or fail together
+        db.session.add(checkpoint)
+        db.session.commit()
+
+        elapsed = max(time.time() - started, 1e-6)
+        self.out('{}: committed up to line {}, {} transactions, {} units, '
+                 '{:,.0f} units/s'.format(path, checkpoint.line, transactions,
+                                          units, units / elapsed))
@@ -1,4 +1,8 @@
 from app import app
+from datetime import datetime
+from decimal import Decimal
+from markupsafe import Markup, escape
+import config
 
 
 @app.template_filter('table_data')
@@ -23,3 +27,80 @@ def table_data(s):
 def table_head(s):
     if (isinstance(s, str)):
         return s.replace('_',' ').upper()
+
+
+# ----------
+# Table body, formatter of every column is picked once
+# from the column type instead of checking every cell
+# ----------
+def format_int(s):
+    return "---" if s is None else "{:,}".format(s)
+
+
+def format_float(s):
+    return "---" if s is None else "{:,.2f}".format(s)
+
+
+def format_text(s):
+    if s is None:
+        return "---"
+    # is digit is correct for now since there is no currency involved
+    if s.isdigit():
+        return "{:,}".format(int(s))
+    return str(escape(s))
+
+
+def format_other(s):
+    return "---" if s is None else str(escape(s))
+
+
+def format_any(s):
+    return str(escape(table_data(s)))
+
+
+FORMATTERS = {int: format_int, float: format_float, Decimal: format_float,
+              str: format_text, datetime: format_other}
+
+
+def get_column_formatter(column_type):
+    try:
+        return FORMATTERS.get(column_type.python_type, format_any)
+    except (AttributeError, NotImplementedError):
+        # type without python type e.g. literal or orm entity
+        return format_any
+
+
+def safe_formatter(formatter):
+    # fall back to the generic one for a cell which does not match its column type
+    def format_cell(s):
+        try:
+            return formatter(s)
+        except (TypeError, ValueError, AttributeError):
+            return format_any(s)
+    return format_cell
+
+
+@app.template_global()
+def table_rows(table, row_action=None):
+    """
+    <tr> of every row of the table body (without header and footer row) as one string,
+    row_action is the html of the row buttons with __ID__ as the placeholder of the row id
+    """
+    header = table[0]
+    types = getattr(header, 'types', (None,) * len(header))
+    formatters = [safe_formatter(get_column_formatter(x)) for x in types]
+
+    rows = table[1:]
+    if rows and rows[-1][0] in config.TABLE_FOOTER_KEYWORDS:
+        rows = rows[:-1]
+
+    html = []
+    for row in rows:
+        html.append('<tr>')
+        html.extend('<td>{}</td>'.format(f(s)) for f, s in zip(formatters, row))
+        if row_action is not None:
+            html.append('<td>{}</td>'.format(row_action.replace('__ID__', str(row[0]))
+                                             if isinstance(row[0], int) else ''))
+        html.append('</tr>')
+
+    return Markup(''.join(html))
@@ -1,10 +1,23 @@
 from app import db
-from datetime import datetime
+from flask_sqlalchemy import SignallingSession
+from datetime import datetime, timedelta
+from functools import wraps
+from inspect import signature
+import logging
+import random
+import threading
+import time
 from sqlalchemy.ext.hybrid import hybrid_property
-from sqlalchemy import func, extract, distinct, exists
-from flask import flash
-from config import DEFAULT_PAGE_NUMBER, DEFAULT_POSTS_PER_PAGE, ALL_IN_PAGE_KEYWORD
-from app import utils
+from sqlalchemy.orm import aliased
+from sqlalchemy import func, distinct, exists, or_, and_, case, event, literal, false, exc
+from sqlalchemy.engine import Engine
+from sqlalchemy.sql.dml import UpdateBase
+from sqlalchemy.sql.util import find_tables
+from flask import g, has_app_context
+from config import DEFAULT_PAGE_NUMBER, DEFAULT_POSTS_PER_PAGE, ALL_IN_PAGE_KEYWORD, \
+    INVENTORY_LOTS, TABLE_FOOTER_KEYWORDS, WRITE_RETRY_DEADLINE, WRITE_RETRY_BASE_DELAY, \
+    WRITE_RETRY_MAX_DELAY
+from app import utils, result_cache, write_queue
 
 ITEM_TYPE_LENGTH = 120
 NAME_LENGTH = 120
@@ -12,11 +25,236 @@ CONTACT_LENGTH = 120
 ADDRESS_LENGTH = 200
 NOTES_LENGTH = 250
 
+logger = logging.getLogger(__name__)
+
+# errors of the models outside of a request (e.g. manage.py commands)
+thread_errors = threading.local()
+
 # TODO: Note? Maybe using 'try' approach is not the best way?
 # Need to find a way to handle exception better without throwing
 # destroying front-end appearance
 
-def paginate_query(query, page_num, per_page):
+def get_errors():
+    """
+    {model name: errors} of the current request (or thread outside of a request),
+    so concurrent requests never read the error of each other
+    """
+    if has_app_context():
+        if getattr(g, 'model_errors', None) is None:
+            g.model_errors = {}
+        return g.model_errors
+
+    if not hasattr(thread_errors, 'errors'):
+        thread_errors.errors = {}
+    return thread_errors.errors
+
+
+@event.listens_for(Engine, 'before_execute')
+def track_written_tables(conn, clauseelement, multiparams, params):
+    # every insert, update and delete (orm flush, bulk and core statements)
+    # goes through here, CacheVersion bumps the written tables before the commit
+    if isinstance(clauseelement, UpdateBase):
+        conn.info.setdefault('written_tables', set()).add(clauseelement.table.name)
+
+
+@event.listens_for(Engine, 'commit')
+@event.listens_for(Engine, 'rollback')
+def clear_written_tables(conn):
+    conn.info.pop('written_tables', None)
+
+
+# results of the list views and their totals, see app/result_cache.py
+list_cache = result_cache.create_cache()
+
+
+def cached_total(table_name, key, count_func):
+    """
+    Total counted by count_func, cached in list_cache by key and
+    the data version of table_name the same way as cached_list
+    """
+    if list_cache is None or has_pending_writes():
+        return count_func()
+
+    key = ('total',) + key + ((table_name, CacheVersion.get_version(table_name)),)
+    total = list_cache.get(key)
+    if total is None:
+        total = count_func()
+        list_cache.set(key, total)
+    return total
+
+
+def freeze(value):
+    # hashable and comparable form of a list argument
+    if isinstance(value, dict):
+        return tuple(sorted((k, freeze(v)) for k, v in value.items()))
+    if isinstance(value, (list, tuple, set)):
+        return tuple(freeze(x) for x in value)
+    return value
+
+
+def has_pending_writes():
+    # a result read in the middle of a write does not belong to any committed version
+    return bool(db.session.new or db.session.dirty or db.session.deleted or
+                db.session.connection().info.get('written_tables'))
+
+
+# lock contention errors which are worth retrying,
+# sqlite messages and postgresql serialization failure, deadlock and lock not available codes
+BUSY_MESSAGES = ('database is locked', 'database is busy')
+BUSY_PGCODES = ('40001', '40P01', '55P03')
+
+# counters of the model writes, see write_transaction
+write_metrics = {'writes': 0, 'retried_writes': 0, 'retries': 0, 'busy_failures': 0}
+write_metrics_lock = threading.Lock()
+
+
+def count_write(**counts):
+    with write_metrics_lock:
+        for name, count in counts.items():
+            write_metrics[name] += count
+
+
+def get_write_metrics():
+    with write_metrics_lock:
+        return dict(write_metrics)
+
+
+def is_busy(error):
+    if not isinstance(error, exc.DBAPIError):
+        return False
+    return getattr(error.orig, 'pgcode', None) in BUSY_PGCODES or \
+        any(x in str(error.orig) for x in BUSY_MESSAGES)
+
+
+def write_transaction(func):
+    """
+    Run a try_* write of a model as one transaction which takes the write lock
+    up front (BEGIN IMMEDIATE on sqlite) and run it again with jittered backoff
+    while it fails because the database is busy, until WRITE_RETRY_DEADLINE.
+    Writes called by another write, or with orm changes or writes of the
+    caller in the session, are part of the caller's transaction and run once.
+    With WRITE_QUEUE on, writes which commit themselves run in the writer thread
+    """
+    func_signature = signature(func)
+
+    @wraps(func)
+    def wrapper(cls, *args, **kwargs):
+        session = db.session
+        if session.info.get('write_transaction') or has_pending_writes():
+            return func(cls, *args, **kwargs)
+
+        if write_queue.writer.enabled and not write_queue.writer.is_writer():
+            arguments = func_signature.bind(cls, *args, **kwargs)
+            arguments.apply_defaults()
+            # writes left open for the caller to commit stay in its transaction
+            if arguments.arguments.get('commit', True):
+                return queue_write(cls, func, args, kwargs)
+
+        deadline = time.time() + WRITE_RETRY_DEADLINE
+        retries = 0
+        session.info['write_transaction'] = True
+        try:
+            while True:
+                errors = {k: list(v) for k, v in get_errors().items()}
+                try:
+                    # end the read transaction of the request before taking the lock
+                    session.rollback()
+                    session.connection(execution_options={'sqlite_begin': 'IMMEDIATE'})
+                except exc.DBAPIError as e:
+                    session.rollback()
+                    if not is_busy(e):
+                        raise
+                    cls.add_error(e)
+                    result = False
+                else:
+                    result = func(cls, *args, **kwargs)
+
+                busy = not result and any(is_busy(x) for k, v in get_errors().items()
+                                          for x in v if x not in errors.get(k, ()))
+                if not busy or time.time() >= deadline:
+                    break
+
+                # errors of the failed attempt are not the result of the write
+                get_errors().clear()
+                get_errors().update(errors)
+
+                # full jitter, writers waiting for the same lock spread out
+                time.sleep(random.uniform(0, min(WRITE_RETRY_MAX_DELAY,
+                                                 WRITE_RETRY_BASE_DELAY * 2 ** retries)))
+                retries += 1
+                logger.info('write_transaction busy retry=%d func=%s.%s',
+                            retries, cls.__name__, func.__name__)
+        finally:
+            session.info.pop('write_transaction', None)
+
+        count_write(writes=1, retried_writes=1 if retries else 0, retries=retries,
+                    busy_failures=1 if busy else 0)
+        return result
+    return wrapper
+
+
+def queue_write(cls, func, args, kwargs):
+    """
+    Run the write in the writer thread of write_queue,
+    the errors of the write are added to the errors of this request
+    """
+    errors = {}
+
+    def write():
+        get_errors().clear()
+        try:
+            return func(cls, *args, **kwargs)
+        finally:
+            errors.update(get_errors())
+
+    # end the read transaction, so the following reads see the write
+    db.session.rollback()
+    try:
+        result = write_queue.writer.submit(write)
+    except Exception as e:
+        cls.add_error(e)
+        result = False
+
+    for name, model_errors in errors.items():
+        get_errors().setdefault(name, [])[:0] = model_errors
+    count_write(writes=1)
+    return result
+
+
+def cached_list(tables_attr):
+    """
+    Cache the result of a list classmethod in list_cache by its arguments and
+    the data versions of the tables named by the class attribute tables_attr,
+    results ordered by an order_by expression are not cached
+    """
+    def decorator(func):
+        func_signature = signature(func)
+
+        @wraps(func)
+        def wrapper(cls, *args, **kwargs):
+            arguments = func_signature.bind(cls, *args, **kwargs)
+            arguments.apply_defaults()
+            arguments = dict(arguments.arguments)
+            del arguments['cls']
+
+            if list_cache is None or arguments.get('order_by') is not None or has_pending_writes():
+                return func(cls, *args, **kwargs)
+
+            versions = CacheVersion.get_versions()
+            key = (cls.__name__, func.__name__, freeze(arguments),
+                   tuple((x, versions.get(x, 0)) for x in getattr(cls, tables_attr)))
+
+            result = list_cache.get(key)
+            if result is None:
+                result = func(cls, *args, **kwargs)
+                list_cache.set(key, list(result))
+            # callers may change the rows of their list
+            return list(result)
+        return wrapper
+    return decorator
+
+
+def paginate_query(query, page_num, per_page, cursor=None, keys=None):
     # page num check
     if utils.is_int(page_num):
         page_num = int(page_num)
@@ -31,91 +269,328 @@ def paginate_query(query, page_num, per_page):
     else:
         per_page = DEFAULT_POSTS_PER_PAGE
 
+    # seek after the last row of the previous page if the cursor was made for this page,
+    # offset is only used to jump into an arbitrary page
+    position = utils.decode_cursor(cursor) if cursor and keys else None
+    if position and position[:2] == (page_num, per_page) and len(position[2]) == len(keys):
+        return query.filter(seek_filter(keys, position[2])).limit(per_page)
+
     # index starts with 0
     start_offset = (page_num - 1) * per_page
     return query.slice(start_offset, start_offset + per_page)
 
 
-def validate_transactions(cls, purchase_trans=False, sale_trans=False):
+def seek_filter(keys, values):
     """
-    Validating transactions
-    Will delete transaction record if there is no items inside it
-    This caused by deletion of Item from ItemType
-    or Item from PurchaseTransaction which breaching the integrity
-    of Sale Transaction
+    Rows after values in the order of keys, keys are (column, label, descending)
+    e.g. date desc, id -> date < v1 OR (date = v1 AND id > v2)
     """
-    # Not using try_delete because purchase trans will also call this
-    # function
+    criteria = []
+    for i, (column, label, descending) in enumerate(keys):
+        equal = [keys[j][0] == values[j] for j in range(i)]
+        after = column < values[i] if descending else column > values[i]
+        criteria.append(and_(*(equal + [after])))
+    return or_(*criteria)
 
-    if purchase_trans:
-        # purchase trans without any of items referencing
-        pq = db.session.query(PurchaseTransaction.id).filter(
-            ~exists().where(PurchaseTransaction.id == Item.purchase_transaction_id))
 
-        print("Going to be deleted purchase trans: {}".format(pq.all()))
+def order_query(query, order_by=None, keys=None):
+    """
+    Order by order_by if given, otherwise by the list keys
+    """
+    if order_by is not None:
+        return query.order_by(order_by)
+    return query.order_by(*[column.desc() if descending else column
+                            for column, label, descending in keys])
 
-        for p in pq:
-            pt = PurchaseTransaction.query.get(p)
-            db.session.delete(pt)
 
-        try:
-            db.session.commit()
-        except Exception as e:
-            cls.add_error(e)
-            return False
+def get_next_cursor(keys, table, page_num, per_page):
+    """
+    Cursor of the page after table (get_list result with header),
+    None if it is the last page or every row is in one page
+    """
+    if not utils.is_int(page_num) or not utils.is_int(per_page):
+        return None
 
-    if sale_trans:
-        # sale trans without any of items referencing
-        sq = db.session.query(SaleTransaction.id).filter(
-            ~exists().where(SaleTransaction.id == Item.sale_transaction_id))
+    rows = [x for x in table[1:] if x and x[0] not in TABLE_FOOTER_KEYWORDS]
+    if len(rows) < int(per_page):
+        return None
 
-        print("Going to be deleted sale trans: {}".format(sq.all()))
+    header = list(table[0])
+    return utils.encode_cursor(int(page_num) + 1, int(per_page),
+                               [rows[-1][header.index(label)] for column, label, descending in keys])
 
-        for s in sq:
-            st = SaleTransaction.query.get(s)
-            db.session.delete(st)
 
-        try:
-            db.session.commit()
-        except Exception as e:
-            cls.add_error(e)
-            return False
+def filter_dates(column, year=None, month=None, day=None, date_from=None, date_to=None,
+                 where=None):
+    """
+    Criterion of the selected years, months and days (and from/to dates, both inclusive)
+    on a datetime column as half open ranges, so the index of the column can be used,
+    None if there is nothing selected.
+    where is the criterion of the rows the column is filtered on, ranges outside
+    of their first and last date are left out to keep the number of parameters low
+    """
+    years = sorted(set(int(x) for x in year or () if utils.is_int(x) and 0 < int(x) < 9999))
+    months = sorted(set(int(x) for x in month or () if utils.is_int(x) and 1 <= int(x) <= 12))
+    days = sorted(set(int(x) for x in day or () if utils.is_int(x) and 1 <= int(x) <= 31))
+
+    criteria = []
+    if years or months or days:
+        first = last = None
+        if months or days or not years:
+            q = db.session.query(func.min(column), func.max(column))
+            if where is not None:
+                q = q.filter(where)
+            first, last = q.one()
+
+        if not years:
+            # only month or day is selected, use the years which have records
+            years = range(first.year, last.year + 1) if first else []
+
+        ranges = []
+        for y in years:
+            if not months and not days:
+                ranges.append((datetime(y, 1, 1), datetime(y + 1, 1, 1)))
+                continue
+
+            for m in months or range(1, 13):
+                month_start = datetime(y, m, 1)
+                month_end = datetime(y + 1, 1, 1) if m == 12 else datetime(y, m + 1, 1)
+                if not days:
+                    ranges.append((month_start, month_end))
+                    continue
+
+                for d in days:
+                    # skip day which is not in the month e.g. 31 of April
+                    if d <= (month_end - month_start).days:
+                        start = datetime(y, m, d)
+                        ranges.append((start, start + timedelta(days=1)))
+
+        if first is not None:
+            ranges = [(start, end) for start, end in ranges if end > first and start <= last]
+
+        criteria.append(or_(*[and_(column >= start, column < end)
+                              for start, end in utils.merge_ranges(ranges)]) if ranges else false())
+
+    date_from = utils.parse_date(date_from)
+    if date_from:
+        criteria.append(column >= date_from)
+
+    date_to = utils.parse_date(date_to)
+    if date_to:
+        criteria.append(column < date_to + timedelta(days=1))
+
+    return and_(*criteria) if criteria else None
+
+
+def filter_ids(column, ids):
+    """
+    Criterion matching column with list of ids,
+    consecutive ids are merged into BETWEEN ranges so long
+    id lists do not exceed the bound parameter limit of SQLite
+    """
+    singles = []
+    criteria = []
+    for start, end in utils.id_ranges(ids):
+        if start == end:
+            singles.append(start)
+        else:
+            criteria.append(column.between(start, end))
+
+    if singles:
+        criteria.append(column.in_(singles))
+    return or_(*criteria)
+
+
+def get_item_transaction_ids(item_type_id=None, purchase_transaction_id=None):
+    """
+    Get (purchase transaction ids, sale transaction ids) which have
+    items of the item type or items from the purchase transaction,
+    used to know which transactions are touched before a deletion
+    """
+    model = ItemLot if INVENTORY_LOTS else Item
+
+    criteria = []
+    if item_type_id is not None:
+        criteria.append(model.item_type_id == item_type_id)
+    if purchase_transaction_id is not None:
+        criteria.append(model.purchase_transaction_id == purchase_transaction_id)
+
+    pq = db.session.query(distinct(model.purchase_transaction_id)).filter(*criteria)
+
+    if INVENTORY_LOTS:
+        sq = db.session.query(distinct(LotAllocation.sale_transaction_id)) \
+            .join(ItemLot) \
+            .filter(*criteria)
+    else:
+        sq = db.session.query(distinct(Item.sale_transaction_id)) \
+            .filter(Item.sale_transaction_id != None) \
+            .filter(*criteria)
+
+    return [x[0] for x in pq], [x[0] for x in sq]
+
+
+def get_transaction_item_type_ids(purchase_ids=(), sale_ids=()):
+    """
+    Get ids of the item types bought in the purchase transactions
+    or sold in the sale transactions, used to know which stock
+    summaries are touched before a deletion
+    """
+    model = ItemLot if INVENTORY_LOTS else Item
+    item_type_ids = set()
+
+    if purchase_ids:
+        item_type_ids.update(x[0] for x in db.session.query(distinct(model.item_type_id))
+                             .filter(filter_ids(model.purchase_transaction_id, purchase_ids)))
+
+    if sale_ids:
+        if INVENTORY_LOTS:
+            q = db.session.query(distinct(ItemLot.item_type_id)) \
+                .select_from(LotAllocation) \
+                .join(ItemLot) \
+                .filter(filter_ids(LotAllocation.sale_transaction_id, sale_ids))
+        else:
+            q = db.session.query(distinct(Item.item_type_id)) \
+                .filter(filter_ids(Item.sale_transaction_id, sale_ids))
+        item_type_ids.update(x[0] for x in q)
+
+    return item_type_ids
+
 
+def validate_transactions(cls, purchase_ids=None, sale_ids=None, commit=True):
+    """
+    Validating transactions
+    Will delete transaction record if there is no items inside it
+    This caused by deletion of Item from ItemType
+    or Item from PurchaseTransaction which breaching the integrity
+    of Sale Transaction
+
+    Only the given transaction ids are checked (the ones touched by
+    the deletion), each table is cleaned by one DELETE ... WHERE NOT EXISTS.
+    Without commit the caller commits the deletion together with its own
+    """
+    # Not using try_delete because purchase trans will also call this
+    # function
+    purchase_deleted = 0
+    sale_deleted = 0
+
+    try:
+        if purchase_ids:
+            # purchase trans without any of items referencing
+            if INVENTORY_LOTS:
+                referenced = exists().where(PurchaseTransaction.id == ItemLot.purchase_transaction_id)
+            else:
+                referenced = exists().where(PurchaseTransaction.id == Item.purchase_transaction_id)
+
+            purchase_deleted = PurchaseTransaction.query \
+                .filter(filter_ids(PurchaseTransaction.id, purchase_ids)) \
+                .filter(~referenced) \
+                .delete(synchronize_session=False)
+
+        if sale_ids:
+            # sale trans without any of items referencing
+            if INVENTORY_LOTS:
+                referenced = exists().where(SaleTransaction.id == LotAllocation.sale_transaction_id)
+            else:
+                referenced = exists().where(SaleTransaction.id == Item.sale_transaction_id)
+
+            sale_deleted = SaleTransaction.query \
+                .filter(filter_ids(SaleTransaction.id, sale_ids)) \
+                .filter(~referenced) \
+                .delete(synchronize_session=False)
+
+        if commit:
+            db.session.commit()
+    except Exception as e:
+        cls.add_error(e)
+        db.session.rollback()
+        return False
+
+    logger.info('validate_transactions model=%s purchase_checked=%d purchase_deleted=%d '
+                'sale_checked=%d sale_deleted=%d',
+                cls.__name__, len(purchase_ids or ()), purchase_deleted,
+                len(sale_ids or ()), sale_deleted)
     return True
 
 
 class STModel(db.Model):
     __abstract__ = True
 
-    errors = []
-
     def __repr__(self):
         return "{}({})".format(self.__class__.__name__, vars(self))
 
     @classmethod
     def add_error(cls, error):
         # limit to only 10 errors
-        cls.errors.insert(0, error)
-        cls.errors = cls.errors[:10]
+        errors = get_errors().setdefault(cls.__name__, [])
+        errors.insert(0, error)
+        del errors[10:]
+
+    @utils.classproperty
+    def errors(cls):
+        """
+        Errors of the current request, newest first
+        """
+        return get_errors().get(cls.__name__, [])
 
     @utils.classproperty
     def error(cls):
-        return cls.errors[0]
+        return cls.errors[0] if cls.errors else None
 
     @utils.classproperty
     def total(cls):
-        q = db.session.query(func.count(cls.id))
-        return q.scalar()
+        return cls.count()
+
+    @classmethod
+    def count(cls, **filters):
+        """
+        Number of rows in the list view with the filters,
+        cached by the data version of count_table
+        """
+        key = (cls.__name__,) + tuple(sorted((k, tuple(v) if isinstance(v, list) else v)
+                                             for k, v in filters.items()))
+        return cached_total(cls.count_table, key, lambda: cls.count_query(**filters).scalar())
+
+    @utils.classproperty
+    def count_table(cls):
+        return cls.__table__.name
+
+    @classmethod
+    def count_query(cls, **filters):
+        return db.session.query(func.count(cls.id))
+
+    @utils.classproperty
+    def list_keys(cls):
+        """
+        (column, label in the list row, descending) the list view is ordered by,
+        unique together so the next page can seek after the last row
+        """
+        return ((cls.id, 'id', False),)
+
+    @utils.classproperty
+    def list_tables(cls):
+        """
+        Names of the tables read by get_list
+        """
+        return get_query_tables(cls.list_query())
+
+    @classmethod
+    def list_query(cls, order_by=None, **kwargs):
+        """
+        Query of the list view without pagination,
+        shared by get_list and the csv export
+        """
+        raise NotImplementedError("Please implement this base method class")
 
     @classmethod
     def get_list(cls, page_num=DEFAULT_PAGE_NUMBER,
                  list_per_page=DEFAULT_POSTS_PER_PAGE,
                  include_header=True,
-                 order_by=None, **kwargs):
+                 order_by=None, cursor=None, **kwargs):
         raise NotImplementedError("Please implement this base method class")
 
     @classmethod
-    def try_delete(cls, id, **kwargs):
+    @write_transaction
+    def try_delete(cls, id, commit=True, **kwargs):
         item = cls.query.get(id)
         if item is None:
             cls.add_error('No data found')
@@ -123,7 +598,10 @@ class STModel(db.Model):
 
         try:
             db.session.delete(item)
-            db.session.commit()
+            if commit:
+                db.session.commit()
+            else:
+                db.session.flush()
             return True
         except Exception as e:
             cls.add_error(e)
@@ -135,15 +613,34 @@ class STModel(db.Model):
         return cls.query.get(id)
 
     @classmethod
-    def update(cls, item):
-        if not isinstance(item, db.Model):
-            raise TypeError('Updated model must derive from Model')
+    @write_transaction
+    def update(cls, id, **fields):
+        """
+        Set the fields of the row with id in one commit
+        """
+        item = cls.query.get(id)
+        if item is None:
+            cls.add_error('No data found')
+            return False
 
-        db.session.add(item)
-        db.session.commit()
+        try:
+            for name, value in fields.items():
+                setattr(item, name, value)
+            db.session.commit()
+            return True
+        except Exception as e:
+            cls.add_error(e)
+            db.session.rollback()
+            return False
 
 
 class Item(STModel):
+    # stock lookup (FIFO claim) goes by item type and unsold items,
+    # the transactions read their items by transaction and item type
+    __table_args__ = (db.Index('ix_item_stock', 'item_type_id', 'sale_transaction_id', 'purchase_transaction_id'),
+                      db.Index('ix_item_purchase', 'purchase_transaction_id', 'item_type_id'),
+                      db.Index('ix_item_sale', 'sale_transaction_id', 'item_type_id'))
+
     id = db.Column(db.Integer, primary_key=True)
 
     item_type_id = db.Column(db.Integer, db.ForeignKey('item_type.id'), nullable=False)
@@ -163,36 +660,153 @@ class Item(STModel):
         else:
             return None
 
+    @classmethod
+    def bulk_insert(cls, rows):
+        """
+        Insert many items with a single executemany statement
+        instead of adding and flushing one ORM object per unit.
+        rows is a list of dict keyed by item column names
+        """
+        if not rows:
+            return
+
+        # pending objects (e.g. the new transaction) need to be
+        # written first because the rows reference their id
+        db.session.flush()
+        db.session.execute(cls.__table__.insert(), rows)
+
+    @classmethod
+    def fifo_query(cls, item_type_id):
+        """
+        Unsold item ids of item type, oldest purchase transaction first
+        """
+        return db.session.query(Item.id) \
+            .join(PurchaseTransaction) \
+            .filter(Item.sale_transaction_id == None) \
+            .filter(Item.item_type_id == item_type_id) \
+            .order_by(PurchaseTransaction.transaction_date, Item.id)
+
+    @classmethod
+    def allocate(cls, trans_id, item_type_id, quantity, sale_price):
+        """
+        Claim the oldest unsold units of item type for sale transaction
+        using FIFO, in one UPDATE statement unless a concurrent sale
+        holds some of them.
+        Return False if there is not enough stock, the caller
+        is expected to rollback in that case
+        """
+        if quantity <= 0:
+            return True
+
+        # on PostgreSQL the units locked by a concurrent sale are skipped
+        # first, so sales of one item type do not queue behind each other.
+        # The shortfall is then claimed waiting for those locks, since the
+        # other sale may roll back or leave some units unsold
+        claimed = cls.claim(trans_id, item_type_id, quantity, sale_price, skip_locked=True)
+        while claimed < quantity:
+            more = cls.claim(trans_id, item_type_id, quantity - claimed, sale_price)
+            if not more:
+                break
+            claimed += more
+
+        # fewer rows than requested means the stock ran out
+        return claimed == quantity
+
+    @classmethod
+    def claim(cls, trans_id, item_type_id, quantity, sale_price, skip_locked=False):
+        """
+        Claim up to quantity of the oldest unsold units in one UPDATE statement,
+        return the number of units claimed
+        """
+        # correlate(None) stops the subquery from sharing the
+        # item table of the enclosing UPDATE. On PostgreSQL the candidates
+        # are locked (SQLite takes the write lock for the whole database instead)
+        fifo_ids = cls.fifo_query(item_type_id) \
+            .limit(quantity) \
+            .with_for_update(of=Item) \
+            .statement
+        if skip_locked:
+            fifo_ids = fifo_ids.suffix_with('SKIP LOCKED', dialect='postgresql')
+
+        # a unit sold since the subquery read it is not claimed twice,
+        # it is missing from the row count instead
+        return Item.query.filter(Item.id.in_(fifo_ids.correlate(None))) \
+            .filter(Item.sale_transaction_id == None) \
+            .update({Item.sale_price: sale_price,
+                     Item.sale_transaction_id: trans_id},
+                    synchronize_session=False)
+
+    @classmethod
+    def release(cls, trans_id, item_type_id=None, quantity=None):
+        """
+        Put items of sale transaction back to stock in one UPDATE statement.
+        Without quantity every item (of the item type) is released,
+        otherwise the most recently purchased ones are released first
+        so the older stock stays sold as FIFO would pick it
+        """
+        if quantity is None:
+            q = Item.query.filter(Item.sale_transaction_id == trans_id)
+            if item_type_id is not None:
+                q = q.filter(Item.item_type_id == item_type_id)
+        else:
+            lifo_ids = db.session.query(Item.id) \
+                .join(PurchaseTransaction) \
+                .filter(Item.sale_transaction_id == trans_id) \
+                .filter(Item.item_type_id == item_type_id) \
+                .order_by(PurchaseTransaction.transaction_date.desc(), Item.id.desc()) \
+                .limit(quantity) \
+                .statement.correlate(None)
+            q = Item.query.filter(Item.id.in_(lifo_ids))
+
+        return q.update({Item.sale_price: None,
+                         Item.sale_transaction_id: None},
+                        synchronize_session=False)
+
+    @classmethod
+    def reprice(cls, trans_id, item_type_id, sale_price):
+        """
+        Change sale price of every item of item type in sale transaction
+        """
+        Item.query \
+            .filter(Item.sale_transaction_id == trans_id) \
+            .filter(Item.item_type_id == item_type_id) \
+            .update({Item.sale_price: sale_price}, synchronize_session=False)
+
     @utils.classproperty
     def total_item_stock(cls):
-        q = db.session.query(func.count(Item.id)) \
-            .group_by(Item.item_type_id)
-        return len(q.all())
+        return ItemTypeStock.total
+
+    @utils.classproperty
+    def list_keys(cls):
+        # newest first
+        return ((Item.id, 'id', True),)
+
+    @classmethod
+    def list_query(cls, order_by=None, **kwargs):
+        return db.session.query(Item.id,
+                                ItemType.item_type,
+                                Item.purchase_price.label('purchase_price'),
+                                Item.sale_price.label('sale_price'),
+                                PurchaseTransaction.transaction_date.label('purchase_transaction_date'),
+                                SaleTransaction.transaction_date.label('sale_transaction_date'),
+                                Supplier.name.label('supplier')) \
+            .outerjoin(ItemType, PurchaseTransaction, SaleTransaction, Supplier) \
+            .order_by(order_by if order_by is not None else Item.id.desc())
 
     @classmethod
+    @cached_list('list_tables')
     def get_list(cls, page_num=DEFAULT_PAGE_NUMBER,
                  list_per_page=DEFAULT_POSTS_PER_PAGE,
                  include_header=True,
-                 order_by=None, **kwargs):
+                 order_by=None, cursor=None, **kwargs):
         purchase_price_label = 'purchase_price'
         sale_price_label = 'sale_price'
-        purchase_transaction_label = 'purchase_transaction_date'
-        sale_transaction_label = 'sale_transaction_date'
-
-        q = db.session.query(Item.id,
-                             ItemType.item_type,
-                             Item.purchase_price.label(purchase_price_label),
-                             Item.sale_price.label(sale_price_label),
-                             PurchaseTransaction.transaction_date.label(purchase_transaction_label),
-                             SaleTransaction.transaction_date.label(sale_transaction_label),
-                             Supplier.name.label('supplier')) \
-            .outerjoin(ItemType, PurchaseTransaction, SaleTransaction, Supplier) \
-            .order_by(Item.id.desc())
 
-        q = paginate_query(q, page_num, list_per_page)
+        q = cls.list_query(order_by)
+        q = paginate_query(q, page_num, list_per_page, cursor, cls.list_keys if order_by is None else None)
         at_list = q.all()
 
-        column_names = tuple(x['name'] for x in q.column_descriptions)
+        column_names = utils.TableHeader(q.column_descriptions)
 
         purchase_price_id = column_names.index(purchase_price_label)
         sale_price_id = column_names.index(sale_price_label)
@@ -209,31 +823,453 @@ class Item(STModel):
         return at_list
 
     @classmethod
-    def get_stock_list(cls, page_num=DEFAULT_PAGE_NUMBER, list_per_page=DEFAULT_POSTS_PER_PAGE):
-        q = db.session.query(Item.item_type_id,
-                             ItemType.item_type,
-                             (func.count(Item.purchase_transaction_id) - func.count(Item.sale_transaction_id)).label(
-                                 'stock_qty'),
-                             func.count(Item.sale_transaction_id).label('sold_qty'),
-                             func.count(Item.id).label('total_qty'),
-                             func.sum(Item.profit).label('total_proft_from_sold')) \
+    def stock_totals(cls):
+        """
+        (item_type_id, purchased, sold, stock, profit) counted from the items,
+        source of ItemTypeStock
+        """
+        sold_profit = case([(Item.sale_transaction_id != None, Item.sale_price - Item.purchase_price)])
+
+        return db.session.query(Item.item_type_id,
+                                func.count(Item.id),
+                                func.count(Item.sale_transaction_id),
+                                func.count(Item.id) - func.count(Item.sale_transaction_id),
+                                func.coalesce(func.sum(sold_profit), 0)) \
+            .group_by(Item.item_type_id)
+
+    @classmethod
+    def stock_query(cls):
+        return db.session.query(ItemTypeStock.item_type_id,
+                                ItemType.item_type,
+                                ItemTypeStock.stock.label('stock_qty'),
+                                ItemTypeStock.sold.label('sold_qty'),
+                                ItemTypeStock.purchased.label('total_qty'),
+                                ItemTypeStock.profit.label('total_proft_from_sold')) \
             .join(ItemType) \
-            .group_by(Item.item_type_id) \
-            .order_by(Item.item_type_id)
+            .order_by(ItemTypeStock.item_type_id)
 
-        q = paginate_query(q, page_num, list_per_page)
+    @utils.classproperty
+    def stock_keys(cls):
+        return ((ItemTypeStock.item_type_id, 'item_type_id', False),)
+
+    @utils.classproperty
+    def stock_tables(cls):
+        return get_query_tables(cls.stock_query())
+
+    @classmethod
+    @cached_list('stock_tables')
+    def get_stock_list(cls, page_num=DEFAULT_PAGE_NUMBER, list_per_page=DEFAULT_POSTS_PER_PAGE,
+                       cursor=None):
+        q = cls.stock_query()
+        q = paginate_query(q, page_num, list_per_page, cursor, cls.stock_keys)
 
         is_list = q.all()
-        is_list.insert(0, tuple(x['name'] for x in q.column_descriptions))
+        is_list.insert(0, utils.TableHeader(q.column_descriptions))
         return is_list
 
 
+class ItemLot(STModel):
+    """
+    Lot of fungible items bought in one purchase transaction,
+    one row per purchase transaction, item type and price.
+    Used instead of Item when INVENTORY_LOTS is on
+    """
+    __table_args__ = (db.Index('ix_item_lot_stock', 'item_type_id', 'remaining'),
+                      db.Index('ix_item_lot_purchase', 'purchase_transaction_id', 'item_type_id'))
+
+    id = db.Column(db.Integer, primary_key=True)
+
+    item_type_id = db.Column(db.Integer, db.ForeignKey('item_type.id'), nullable=False)
+    purchase_transaction_id = db.Column(db.Integer,
+                                        db.ForeignKey('purchase_transaction.id'),
+                                        nullable=False)
+    purchase_price = db.Column(db.Integer, nullable=False)
+
+    quantity = db.Column(db.Integer, nullable=False)
+    remaining = db.Column(db.Integer, nullable=False)
+
+    allocations = db.relationship('LotAllocation', backref='lot', lazy='dynamic',
+                                  cascade='save-update, merge, delete')
+
+    @utils.classproperty
+    def list_keys(cls):
+        # newest first
+        return ((ItemLot.id, 'id', True),)
+
+    @classmethod
+    def list_query(cls, order_by=None, **kwargs):
+        return db.session.query(ItemLot.id,
+                                ItemType.item_type,
+                                ItemLot.purchase_price.label('purchase_price'),
+                                ItemLot.quantity,
+                                ItemLot.remaining,
+                                PurchaseTransaction.transaction_date.label('purchase_transaction_date'),
+                                Supplier.name.label('supplier')) \
+            .join(ItemType, PurchaseTransaction, Supplier) \
+            .order_by(order_by if order_by is not None else ItemLot.id.desc())
+
+    @classmethod
+    @cached_list('list_tables')
+    def get_list(cls, page_num=DEFAULT_PAGE_NUMBER,
+                 list_per_page=DEFAULT_POSTS_PER_PAGE,
+                 include_header=True,
+                 order_by=None, cursor=None, **kwargs):
+        purchase_price_label = 'purchase_price'
+
+        q = cls.list_query(order_by)
+        q = paginate_query(q, page_num, list_per_page, cursor, cls.list_keys if order_by is None else None)
+        l_list = q.all()
+
+        column_names = utils.TableHeader(q.column_descriptions)
+
+        purchase_price_id = column_names.index(purchase_price_label)
+        quantity_id = column_names.index('quantity')
+        remaining_id = column_names.index('remaining')
+
+        total_row = [''] * len(column_names)
+        total_row[0] = 'TOTAL'
+        total_row[purchase_price_id] = sum(x[purchase_price_id] * x[quantity_id] for x in l_list)
+        total_row[quantity_id] = sum(x[quantity_id] for x in l_list)
+        total_row[remaining_id] = sum(x[remaining_id] for x in l_list)
+
+        l_list.append(tuple(total_row))
+        l_list.insert(0, column_names)
+
+        return l_list
+
+    @classmethod
+    def stock_totals(cls):
+        """
+        (item_type_id, purchased, sold, stock, profit) counted from the lots,
+        source of ItemTypeStock
+        """
+        lot = aliased(ItemLot)
+        profit = db.session.query(func.sum((LotAllocation.sale_price - lot.purchase_price) *
+                                           LotAllocation.quantity)) \
+            .select_from(LotAllocation) \
+            .join(lot, LotAllocation.lot_id == lot.id) \
+            .filter(lot.item_type_id == ItemLot.item_type_id) \
+            .as_scalar()
+
+        return db.session.query(ItemLot.item_type_id,
+                                func.sum(ItemLot.quantity),
+                                func.sum(ItemLot.quantity) - func.sum(ItemLot.remaining),
+                                func.sum(ItemLot.remaining),
+                                func.coalesce(profit, 0)) \
+            .group_by(ItemLot.item_type_id)
+
+    @classmethod
+    def bulk_insert(cls, rows):
+        """
+        Insert lots with a single executemany statement,
+        rows is a list of dict keyed by item lot column names
+        """
+        if not rows:
+            return
+
+        db.session.flush()
+        db.session.execute(cls.__table__.insert(), rows)
+
+    @classmethod
+    def refresh_remaining(cls, lot_ids=None):
+        """
+        Recalculate remaining quantity from the allocations
+        of the given lots (or every lot if lot_ids is None)
+        """
+        allocated = db.session.query(func.coalesce(func.sum(LotAllocation.quantity), 0)) \
+            .filter(LotAllocation.lot_id == ItemLot.id) \
+            .as_scalar()
+
+        q = ItemLot.query
+        if lot_ids is not None:
+            if not lot_ids:
+                return
+            q = q.filter(ItemLot.id.in_(lot_ids))
+
+        q.update({ItemLot.remaining: ItemLot.quantity - allocated},
+                 synchronize_session=False)
+
+    @classmethod
+    def get_transaction_lot_ids(cls, purchase_ids=None, sale_ids=None):
+        """
+        Ids of the lots bought in the purchase transactions
+        or allocated to the sale transactions
+        """
+        criteria = []
+        if purchase_ids:
+            criteria.append(filter_ids(ItemLot.purchase_transaction_id, purchase_ids))
+        if sale_ids:
+            allocated = db.session.query(LotAllocation.lot_id) \
+                .filter(filter_ids(LotAllocation.sale_transaction_id, sale_ids))
+            criteria.append(ItemLot.id.in_(allocated.subquery()))
+
+        if not criteria:
+            return []
+        return [x[0] for x in db.session.query(ItemLot.id).filter(or_(*criteria))]
+
+    @classmethod
+    def fifo_query(cls, item_type_id):
+        """
+        Lots of item type with remaining stock, oldest purchase transaction first
+        """
+        return ItemLot.query.join(PurchaseTransaction) \
+            .filter(ItemLot.item_type_id == item_type_id) \
+            .filter(ItemLot.remaining > 0) \
+            .order_by(PurchaseTransaction.transaction_date, ItemLot.id)
+
+    @classmethod
+    def allocate(cls, trans_id, item_type_id, quantity, sale_price):
+        """
+        Allocate quantity of item type into sale transaction
+        using FIFO (oldest purchase transaction first).
+        Return False if there is not enough stock
+        """
+        # lock the lots until commit, remaining is read then written back
+        lots = cls.fifo_query(item_type_id) \
+            .with_for_update(of=ItemLot) \
+            .populate_existing()
+
+        allocations = []
+        for lot in lots:
+            if quantity <= 0:
+                break
+
+            taken = min(lot.remaining, quantity)
+            lot.remaining -= taken
+            quantity -= taken
+            allocations.append({'lot_id': lot.id,
+                                'sale_transaction_id': trans_id,
+                                'sale_price': sale_price,
+                                'quantity': taken})
+
+        if quantity > 0:
+            return False
+
+        if allocations:
+            db.session.flush()
+            db.session.execute(LotAllocation.__table__.insert(), allocations)
+        return True
+
+    @classmethod
+    def get_allocations(cls, trans_id, item_type_id=None):
+        q = LotAllocation.query.filter(LotAllocation.sale_transaction_id == trans_id)
+        if item_type_id is not None:
+            q = q.filter(LotAllocation.lot_id.in_(
+                db.session.query(ItemLot.id)
+                .filter(ItemLot.item_type_id == item_type_id)
+                .statement.correlate(None)))
+        return q
+
+    @classmethod
+    def release(cls, trans_id, item_type_id=None, quantity=None):
+        """
+        Put items allocated to sale transaction back to their lots.
+        Without quantity every allocation (of the item type) is released,
+        otherwise the most recently purchased lots are released first
+        """
+        q = cls.get_allocations(trans_id, item_type_id)
+
+        if quantity is None:
+            lot_ids = [x.lot_id for x in q]
+            q.delete(synchronize_session=False)
+        else:
+            lot_ids = []
+            allocations = q.join(ItemLot, PurchaseTransaction) \
+                .order_by(PurchaseTransaction.transaction_date.desc(), ItemLot.id.desc())
+
+            for allocation in allocations:
+                if quantity <= 0:
+                    break
+
+                taken = min(allocation.quantity, quantity)
+                quantity -= taken
+                lot_ids.append(allocation.lot_id)
+
+                if taken == allocation.quantity:
+                    db.session.delete(allocation)
+                else:
+                    allocation.quantity -= taken
+
+            db.session.flush()
+
+        cls.refresh_remaining(lot_ids)
+
+    @classmethod
+    def reprice(cls, trans_id, item_type_id, sale_price):
+        """
+        Change sale price of every allocation of item type in sale transaction
+        """
+        cls.get_allocations(trans_id, item_type_id) \
+            .update({LotAllocation.sale_price: sale_price}, synchronize_session=False)
+
+    @classmethod
+    def fold_items(cls, purge=False):
+        """
+        Migrate existing Item rows into lots and allocations.
+        Items with the same purchase transaction, item type and price
+        become one lot, and sold items are grouped into allocation
+        per sale transaction and sale price
+        """
+        if db.session.query(exists().where(ItemLot.id != None)).scalar():
+            raise ValueError('Item lots already exist, items have been folded')
+
+        lot_select = db.session.query(Item.purchase_transaction_id,
+                                      Item.item_type_id,
+                                      Item.purchase_price,
+                                      func.count(Item.id),
+                                      func.count(Item.id) - func.count(Item.sale_transaction_id)) \
+            .group_by(Item.purchase_transaction_id, Item.item_type_id, Item.purchase_price)
+
+        db.session.execute(ItemLot.__table__.insert().from_select(
+            ['purchase_transaction_id', 'item_type_id', 'purchase_price',
+             'quantity', 'remaining'],
+            lot_select.statement))
+
+        allocation_select = db.session.query(ItemLot.id,
+                                             Item.sale_transaction_id,
+                                             Item.sale_price,
+                                             func.count(Item.id)) \
+            .join(Item, (Item.purchase_transaction_id == ItemLot.purchase_transaction_id) &
+                  (Item.item_type_id == ItemLot.item_type_id) &
+                  (Item.purchase_price == ItemLot.purchase_price)) \
+            .filter(Item.sale_transaction_id != None) \
+            .group_by(ItemLot.id, Item.sale_transaction_id, Item.sale_price)
+
+        db.session.execute(LotAllocation.__table__.insert().from_select(
+            ['lot_id', 'sale_transaction_id', 'sale_price', 'quantity'],
+            allocation_select.statement))
+
+        if purge:
+            Item.query.delete(synchronize_session=False)
+
+        db.session.commit()
+
+
+class LotAllocation(STModel):
+    """
+    Quantity of an item lot consumed by a sale transaction
+    """
+    id = db.Column(db.Integer, primary_key=True)
+
+    lot_id = db.Column(db.Integer, db.ForeignKey('item_lot.id'), index=True, nullable=False)
+    sale_transaction_id = db.Column(db.Integer, db.ForeignKey('sale_transaction.id'),
+                                    index=True, nullable=False)
+    sale_price = db.Column(db.Integer, nullable=False)
+    quantity = db.Column(db.Integer, nullable=False)
+
+
+class ItemTypeStock(STModel):
+    """
+    Purchased, sold and in stock quantity and profit of every item type.
+    Write paths record their changes with add (quantity deltas) or
+    touch (count the item types again from the items), both are applied
+    right before the commit, so the summary is always written in the same
+    database transaction as the items
+    """
+    item_type_id = db.Column(db.Integer, db.ForeignKey('item_type.id'), primary_key=True)
+    purchased = db.Column(db.Integer, nullable=False, default=0)
+    sold = db.Column(db.Integer, nullable=False, default=0)
+    stock = db.Column(db.Integer, nullable=False, default=0)
+    profit = db.Column(db.Integer, nullable=False, default=0)
+
+    @classmethod
+    def count_query(cls, **filters):
+        return db.session.query(func.count(ItemTypeStock.item_type_id))
+
+    @classmethod
+    def get_pending(cls, session=None):
+        info = (session or db.session()).info
+        return info.setdefault('item_type_stock', {'deltas': {},
+                                                   'refresh': set(),
+                                                   'refresh_all': False})
+
+    @classmethod
+    def add(cls, item_type_id, purchased=0, sold=0, profit=0):
+        delta = cls.get_pending()['deltas'].setdefault(item_type_id, [0, 0, 0])
+        delta[0] += purchased
+        delta[1] += sold
+        delta[2] += profit
+
+    @classmethod
+    def touch(cls, item_type_ids=None):
+        """
+        Mark item types (every item type if None) to be counted again
+        """
+        pending = cls.get_pending()
+        if item_type_ids is None:
+            pending['refresh_all'] = True
+        else:
+            pending['refresh'].update(item_type_ids)
+
+    @classmethod
+    def refresh(cls, item_type_ids=None):
+        """
+        Count the summary of item types (or every item type) from the items
+        """
+        source = ItemLot if INVENTORY_LOTS else Item
+        totals = source.stock_totals()
+        q = ItemTypeStock.query
+
+        if item_type_ids is not None:
+            if not item_type_ids:
+                return
+            totals = totals.filter(filter_ids(source.item_type_id, item_type_ids))
+            q = q.filter(filter_ids(ItemTypeStock.item_type_id, item_type_ids))
+
+        q.delete(synchronize_session=False)
+        db.session.execute(ItemTypeStock.__table__.insert().from_select(
+            ['item_type_id', 'purchased', 'sold', 'stock', 'profit'],
+            totals.statement))
+
+    @classmethod
+    def apply_pending(cls, session):
+        pending = session.info.pop('item_type_stock', None)
+        if not pending:
+            return
+
+        if pending['refresh_all']:
+            cls.refresh()
+            return
+
+        cls.refresh(pending['refresh'])
+
+        for item_type_id, (purchased, sold, profit) in pending['deltas'].items():
+            if item_type_id in pending['refresh']:
+                continue
+
+            updated = ItemTypeStock.query \
+                .filter(ItemTypeStock.item_type_id == item_type_id) \
+                .update({ItemTypeStock.purchased: ItemTypeStock.purchased + purchased,
+                         ItemTypeStock.sold: ItemTypeStock.sold + sold,
+                         ItemTypeStock.stock: ItemTypeStock.stock + purchased - sold,
+                         ItemTypeStock.profit: ItemTypeStock.profit + profit},
+                        synchronize_session=False)
+
+            # no summary yet for this item type, count it
+            if not updated:
+                cls.refresh([item_type_id])
+
+
+@event.listens_for(SignallingSession, 'before_commit')
+def apply_item_type_stock(session):
+    ItemTypeStock.apply_pending(session)
+
+
+@event.listens_for(SignallingSession, 'after_soft_rollback')
+def discard_item_type_stock(session, previous_transaction):
+    session.info.pop('item_type_stock', None)
+
+
 class ItemType(STModel):
     id = db.Column(db.Integer, primary_key=True)
     item_type = db.Column(db.String(NAME_LENGTH), index=True,
                           unique=True, nullable=False)
     items = db.relationship('Item', backref='item_type', lazy='dynamic',
                             cascade='save-update, merge, delete')
+    lots = db.relationship('ItemLot', backref='item_type', lazy='dynamic',
+                           cascade='save-update, merge, delete')
+    stock = db.relationship('ItemTypeStock', backref='item_type', uselist=False,
+                            cascade='save-update, merge, delete')
 
     @classmethod
     def format_item_type(cls, text):
@@ -244,23 +1280,27 @@ class ItemType(STModel):
         return db.session.query(exists().where(ItemType.item_type == ItemType.format_item_type(item_type))).scalar()
 
     @classmethod
+    def list_query(cls, order_by=None, **kwargs):
+        q = ItemType.query.with_entities(ItemType.id, ItemType.item_type)
+        return order_query(q, order_by, cls.list_keys)
+
+    @classmethod
+    @cached_list('list_tables')
     def get_list(cls, page_num=DEFAULT_PAGE_NUMBER,
                  list_per_page=DEFAULT_POSTS_PER_PAGE,
                  include_header=True,
-                 order_by=None, **kwargs):
-        q = ItemType.query.with_entities(ItemType.id, ItemType.item_type)
-        q = paginate_query(q, page_num, list_per_page)
-
-        if order_by:
-            q = q.order_by(order_by)
+                 order_by=None, cursor=None, **kwargs):
+        q = cls.list_query(order_by)
+        q = paginate_query(q, page_num, list_per_page, cursor, cls.list_keys if order_by is None else None)
 
         it_list = q.all()
 
         if include_header:
-            it_list.insert(0, tuple(x['name'] for x in q.column_descriptions))
+            it_list.insert(0, utils.TableHeader(q.column_descriptions))
         return it_list
 
     @classmethod
+    @write_transaction
     def try_add(cls, item_type):
         # convert name to correct one
         # if item exists in db already -> it has been checked by
@@ -277,14 +1317,30 @@ class ItemType(STModel):
             return False
 
     @classmethod
+    @write_transaction
     def try_delete(cls, id, **kwargs):
-        if super().try_delete(id, **kwargs):
-            if not validate_transactions(cls, True, True):
+        purchase_ids, sale_ids = get_item_transaction_ids(item_type_id=id)
+        TransactionLine.touch(purchase_ids, sale_ids)
+
+        if super().try_delete(id, False, **kwargs):
+            if INVENTORY_LOTS:
+                # deleted lots cascade their allocations, only the lots
+                # of the touched transactions can be affected
+                ItemLot.refresh_remaining(ItemLot.get_transaction_lot_ids(purchase_ids, sale_ids))
+
+            if not validate_transactions(cls, purchase_ids, sale_ids, False):
                 cls.add_error('Fail to validate transaction, item type is '
                               'deleted but some transactions does not have '
                               'items referenced into it')
                 return False
-            return True
+
+            try:
+                db.session.commit()
+                return True
+            except Exception as e:
+                cls.add_error(e)
+                db.session.rollback()
+                return False
         else:
             return False
 
@@ -299,21 +1355,37 @@ class Supplier(STModel):
                                             cascade='save-update, merge, delete')
 
     @classmethod
-    def get_list(cls, page_num=DEFAULT_PAGE_NUMBER,
-                 list_per_page=DEFAULT_POSTS_PER_PAGE,
-                 include_header=True,
-                 order_by=None, **kwargs):
+    def list_query(cls, order_by=None, **kwargs):
         q = Supplier.query.with_entities(Supplier.id,
                                          Supplier.name,
                                          Supplier.contact,
                                          Supplier.address)
-        q = paginate_query(q, page_num, list_per_page)
+        return order_query(q, order_by, cls.list_keys)
+
+    @classmethod
+    @cached_list('list_tables')
+    def get_list(cls, page_num=DEFAULT_PAGE_NUMBER,
+                 list_per_page=DEFAULT_POSTS_PER_PAGE,
+                 include_header=True,
+                 order_by=None, cursor=None, **kwargs):
+        q = cls.list_query(order_by)
+        q = paginate_query(q, page_num, list_per_page, cursor, cls.list_keys if order_by is None else None)
 
         s_list = q.all()
-        s_list.insert(0, tuple(x['name'] for x in q.column_descriptions))
+        s_list.insert(0, utils.TableHeader(q.column_descriptions))
         return s_list
 
     @classmethod
+    @write_transaction
+    def try_delete(cls, id, **kwargs):
+        # purchase transactions and their items are deleted by cascade
+        purchase_ids = [x[0] for x in db.session.query(PurchaseTransaction.id)
+                        .filter(PurchaseTransaction.supplier_id == id)]
+        ItemTypeStock.touch(get_transaction_item_type_ids(purchase_ids=purchase_ids))
+        return super().try_delete(id, **kwargs)
+
+    @classmethod
+    @write_transaction
     def try_add(cls, name, contact, address):
         new = Supplier(name=name, contact=contact, address=address)
         try:
@@ -340,6 +1412,35 @@ class Customer(STModel):
         return db.session.query(exists().where(Customer.name == name)).scalar()
 
     @classmethod
+    @write_transaction
+    def try_delete(cls, id, **kwargs):
+        # sold items of the deleted sale transactions are back in stock
+        sale_ids = [x[0] for x in db.session.query(SaleTransaction.id)
+                    .filter(SaleTransaction.customer_id == id)]
+        item_type_ids = get_transaction_item_type_ids(sale_ids=sale_ids)
+        ItemTypeStock.touch(item_type_ids)
+        if INVENTORY_LOTS:
+            # the allocations are deleted with the sale transactions, so collect their lots first
+            lot_ids = ItemLot.get_transaction_lot_ids(sale_ids=sale_ids)
+
+        if not super().try_delete(id, False, **kwargs):
+            return False
+
+        try:
+            if INVENTORY_LOTS:
+                # allocations of the deleted sale transactions are gone,
+                # so return their quantity back to the lots
+                ItemLot.refresh_remaining(lot_ids)
+                ItemTypeStock.touch(item_type_ids)
+            db.session.commit()
+            return True
+        except Exception as e:
+            cls.add_error(e)
+            db.session.rollback()
+            return False
+
+    @classmethod
+    @write_transaction
     def try_add(cls, name, contact=None, address=None):
         # no need to check exists in here because
         # the form has handled it and the model fields has unique=True
@@ -354,23 +1455,26 @@ class Customer(STModel):
             return False
 
     @classmethod
-    def get_list(cls, page_num=DEFAULT_PAGE_NUMBER,
-                 list_per_page=DEFAULT_POSTS_PER_PAGE,
-                 include_header=True,
-                 order_by=None, **kwargs):
+    def list_query(cls, order_by=None, **kwargs):
         q = Customer.query.with_entities(Customer.id,
                                          Customer.name,
                                          Customer.address,
                                          Customer.contact)
-        q = paginate_query(q, page_num, list_per_page)
+        return order_query(q, order_by, cls.list_keys)
 
-        if order_by:
-            q = q.order_by(order_by)
+    @classmethod
+    @cached_list('list_tables')
+    def get_list(cls, page_num=DEFAULT_PAGE_NUMBER,
+                 list_per_page=DEFAULT_POSTS_PER_PAGE,
+                 include_header=True,
+                 order_by=None, cursor=None, **kwargs):
+        q = cls.list_query(order_by)
+        q = paginate_query(q, page_num, list_per_page, cursor, cls.list_keys if order_by is None else None)
 
         c_list = q.all()
 
         if include_header:
-            c_list.insert(0, tuple(x['name'] for x in q.column_descriptions))
+            c_list.insert(0, utils.TableHeader(q.column_descriptions))
         return c_list
 
 
@@ -384,6 +1488,7 @@ class Courier(STModel):
         return db.session.query(exists().where(Courier.name == name)).scalar()
 
     @classmethod
+    @write_transaction
     def try_add(cls, name):
         # no need to check exists in here because
         # the form has handled it and the model fields has unique=True
@@ -398,20 +1503,23 @@ class Courier(STModel):
             return False
 
     @classmethod
+    def list_query(cls, order_by=None, **kwargs):
+        q = Courier.query.with_entities(Courier.id, Courier.name)
+        return order_query(q, order_by, cls.list_keys)
+
+    @classmethod
+    @cached_list('list_tables')
     def get_list(cls, page_num=DEFAULT_PAGE_NUMBER,
                  list_per_page=DEFAULT_POSTS_PER_PAGE,
                  include_header=True,
-                 order_by=None, **kwargs):
-        q = Courier.query.with_entities(Courier.id, Courier.name)
-        q = paginate_query(q, page_num, list_per_page)
-
-        if order_by:
-            q = q.order_by(order_by)
+                 order_by=None, cursor=None, **kwargs):
+        q = cls.list_query(order_by)
+        q = paginate_query(q, page_num, list_per_page, cursor, cls.list_keys if order_by is None else None)
 
         c_list = q.all()
 
         if include_header:
-            c_list.insert(0, tuple(x['name'] for x in q.column_descriptions))
+            c_list.insert(0, utils.TableHeader(q.column_descriptions))
         return c_list
 
 
@@ -425,6 +1533,7 @@ class TransactionMedium(STModel):
         return db.session.query(exists().where(TransactionMedium.name == name)).scalar()
 
     @classmethod
+    @write_transaction
     def try_add(cls, name):
         new_tm = TransactionMedium(name=name)
         try:
@@ -437,20 +1546,23 @@ class TransactionMedium(STModel):
             return False
 
     @classmethod
+    def list_query(cls, order_by=None, **kwargs):
+        q = TransactionMedium.query.with_entities(TransactionMedium.id, TransactionMedium.name)
+        return order_query(q, order_by, cls.list_keys)
+
+    @classmethod
+    @cached_list('list_tables')
     def get_list(cls, page_num=DEFAULT_PAGE_NUMBER,
                  list_per_page=DEFAULT_POSTS_PER_PAGE,
                  include_header=True,
-                 order_by=None, **kwargs):
-        q = TransactionMedium.query.with_entities(TransactionMedium.id, TransactionMedium.name)
-        q = paginate_query(q, page_num, list_per_page)
-
-        if order_by:
-            q = q.order_by(order_by)
+                 order_by=None, cursor=None, **kwargs):
+        q = cls.list_query(order_by)
+        q = paginate_query(q, page_num, list_per_page, cursor, cls.list_keys if order_by is None else None)
 
         tm_list = q.all()
 
         if include_header:
-            tm_list.insert(0, tuple(x['name'] for x in q.column_descriptions))
+            tm_list.insert(0, utils.TableHeader(q.column_descriptions))
         return tm_list
 
 
@@ -458,8 +1570,10 @@ class PurchaseTransaction(STModel):
     id = db.Column(db.Integer, primary_key=True)
     items = db.relationship('Item', backref='purchase_transaction', lazy='dynamic',
                             cascade='save-update, merge, delete')
+    lots = db.relationship('ItemLot', backref='purchase_transaction', lazy='dynamic',
+                           cascade='save-update, merge, delete')
     transaction_date = db.Column(db.DateTime, index=True, nullable=False)
-    supplier_id = db.Column(db.Integer, db.ForeignKey('supplier.id'), nullable=False)
+    supplier_id = db.Column(db.Integer, db.ForeignKey('supplier.id'), index=True, nullable=False)
     notes = db.Column(db.String(NOTES_LENGTH))
 
     def __init__(self, transaction_date=None, supplier_id=None, notes=None):
@@ -476,76 +1590,101 @@ class PurchaseTransaction(STModel):
         self.notes = notes
 
     @utils.classproperty
-    def total(cls):
-        # there are two ways doing this
-        q = db.session.query(func.count(Item.id)) \
-            .filter(Item.purchase_transaction_id != None) \
-            .group_by(Item.purchase_transaction_id, Item.item_type_id)
-        # in here can use q.count() but apparently it is slower
-        return len(q.all())
-        # OR
-        # q = db.session.query(func.count(distinct(Item.item_type_id)))\
-        #     .filter(Item.purchase_transaction_id != None)\
-        #     .group_by(Item.purchase_transaction_id)
-        # return sum(x[0] for x in q.all())
+    def count_table(cls):
+        return TransactionLine.__table__.name
 
     @classmethod
-    def get_list(cls, page_num=DEFAULT_PAGE_NUMBER,
-                 list_per_page=DEFAULT_POSTS_PER_PAGE,
-                 include_header=True,
-                 order_by=None, ids=None, year=None, month=None, day=None):
+    def count_query(cls, ids=None, year=None, month=None, day=None, date_from=None, date_to=None):
+        # count the lines with the same filters as the list
+        return cls.list_query(None, ids, year, month, day, date_from, date_to) \
+            .order_by(None) \
+            .with_entities(func.count(TransactionLine.id))
 
-        qty_label = 'quantity'
-        individual_price_label = 'price_(each)'
-        total_price_label = 'total_price'
-
-        # initial query
-        q = db.session.query(Item.purchase_transaction_id.label('id'),
-                             ItemType.item_type,
-                             PurchaseTransaction.transaction_date,
-                             func.count(Item.id).label(qty_label),
-                             Item.purchase_price.label(individual_price_label),
-                             func.sum(Item.purchase_price).label(total_price_label),
+    @classmethod
+    def line_query(cls, ids=None):
+        """
+        Lines (one per item type) of purchase transactions (or every purchase transaction if None)
+        counted from the items, source of TransactionLine
+        """
+        if INVENTORY_LOTS:
+            trans_id_column = ItemLot.purchase_transaction_id
+            item_type_id_column = ItemLot.item_type_id
+            q = db.session.query(ItemLot.purchase_transaction_id.label('transaction_id'),
+                                 ItemLot.item_type_id.label('item_type_id'),
+                                 func.sum(ItemLot.quantity).label('quantity'),
+                                 func.max(ItemLot.purchase_price).label('price'),
+                                 func.sum(ItemLot.quantity * ItemLot.purchase_price).label('total_price'))
+        else:
+            trans_id_column = Item.purchase_transaction_id
+            item_type_id_column = Item.item_type_id
+            q = db.session.query(Item.purchase_transaction_id.label('transaction_id'),
+                                 Item.item_type_id.label('item_type_id'),
+                                 func.count(Item.id).label('quantity'),
+                                 func.max(Item.purchase_price).label('price'),
+                                 func.sum(Item.purchase_price).label('total_price'))
+
+        if ids is not None:
+            q = q.filter(filter_ids(trans_id_column, ids))
+
+        # every selected column is grouped or aggregated so the query runs
+        # on databases which reject ungrouped columns (e.g. PostgreSQL)
+        return q.add_columns(literal(False).label('is_sale'),
+                             ItemType.item_type.label('item_type'),
+                             PurchaseTransaction.transaction_date.label('transaction_date'),
                              Supplier.name.label('supplier'),
-                             PurchaseTransaction.notes)
+                             PurchaseTransaction.notes.label('notes')) \
+            .join(ItemType, PurchaseTransaction, Supplier) \
+            .group_by(trans_id_column, item_type_id_column,
+                      ItemType.item_type, PurchaseTransaction.transaction_date,
+                      Supplier.name, PurchaseTransaction.notes)
+
+    @utils.classproperty
+    def list_keys(cls):
+        # item type breaks the tie between lines of the same transaction
+        return ((TransactionLine.transaction_date, 'transaction_date', True),
+                (TransactionLine.transaction_id, 'id', False),
+                (TransactionLine.item_type, 'item_type', False))
+
+    @classmethod
+    def list_query(cls, order_by=None, ids=None, year=None, month=None, day=None,
+                   date_from=None, date_to=None):
+        q = db.session.query(TransactionLine.transaction_id.label('id'),
+                             TransactionLine.item_type,
+                             TransactionLine.transaction_date,
+                             TransactionLine.quantity,
+                             TransactionLine.price.label('price_(each)'),
+                             TransactionLine.total_price,
+                             TransactionLine.supplier,
+                             TransactionLine.notes) \
+            .filter(TransactionLine.is_sale == False)
 
         # filter based on param
         # id is only 1, so if it is not None just skip other filters
         if ids:
-            q = q.filter(Item.purchase_transaction_id.in_(ids))
+            q = q.filter(TransactionLine.transaction_id.in_(ids))
         else:
-            # any is useful for checking ['']
-            # http://stackoverflow.com/questions/11191264/python-how-to-check-list-doest-contain-any-value
-
-            if year and any(year):
-                q = q.filter(extract('year', PurchaseTransaction.transaction_date).in_(year))
-
-            if month and any(month):
-                q = q.filter(extract('month', PurchaseTransaction.transaction_date).in_(month))
+            dates = filter_dates(TransactionLine.transaction_date, year, month, day, date_from, date_to,
+                                 TransactionLine.is_sale == False)
+            if dates is not None:
+                q = q.filter(dates)
 
-            if day and any(day):
-                q = q.filter(extract('day', PurchaseTransaction.transaction_date).in_(day))
+        return order_query(q, order_by, cls.list_keys)
 
-        # finishing query
-        q = q.join(ItemType, PurchaseTransaction, Supplier) \
-            .group_by(Item.purchase_transaction_id, Item.item_type_id)
+    @classmethod
+    @cached_list('list_tables')
+    def get_list(cls, page_num=DEFAULT_PAGE_NUMBER,
+                 list_per_page=DEFAULT_POSTS_PER_PAGE,
+                 include_header=True,
+                 order_by=None, cursor=None, ids=None, year=None, month=None, day=None,
+                 date_from=None, date_to=None):
 
-        # I can use this to add the total row, but one problem is the date_time field needs to have valid date
-        # also the order by needs to be placed last, so maybe it is better to just use python?
-        # q = q.union_all(
-        #     db.session.query(func.count(distinct(Item.purchase_transaction_id)),
-        #                      func.count(distinct(Item.item_type_id)),
-        #                      "'{}'".format(str(datetime.now())),
-        #                      func.count(Item.id),
-        #                      "'test2'",
-        #                      func.sum(Item.purchase_price),
-        #                      "'test3'").join(ItemType, PurchaseTransaction))
+        total_price_label = 'total_price'
 
-        q = q.order_by(PurchaseTransaction.transaction_date.desc())
-        q = paginate_query(q, page_num, list_per_page)
+        q = cls.list_query(order_by, ids, year, month, day, date_from, date_to)
+        q = paginate_query(q, page_num, list_per_page, cursor, cls.list_keys if order_by is None else None)
 
         p_list = q.all()
-        column_names = tuple(x['name'] for x in q.column_descriptions)
+        column_names = utils.TableHeader(q.column_descriptions)
 
         # dynamically check where is total_price column is from column_names
         # add first column name 'TOTAL'
@@ -562,6 +1701,7 @@ class PurchaseTransaction(STModel):
         return p_list
 
     @classmethod
+    @write_transaction
     def try_add(cls, date=None, supplier_id=None, notes=None, transaction_items=None):
         """
         Adding new transaction with date, notes and collections of items
@@ -588,32 +1728,64 @@ class PurchaseTransaction(STModel):
 
 
     @classmethod
+    @write_transaction
     def try_delete(cls, id, **kwargs):
-        if super().try_delete(id, **kwargs):
-            if not validate_transactions(cls, purchase_trans=True):
+        # the transaction itself is deleted, but sale transactions
+        # which sold its items can be left without any item
+        purchase_ids, sale_ids = get_item_transaction_ids(purchase_transaction_id=id)
+        ItemTypeStock.touch(cls.get_item_type_ids(id))
+        TransactionLine.touch([id], sale_ids)
+
+        if super().try_delete(id, False, **kwargs):
+            if not validate_transactions(cls, sale_ids=sale_ids, commit=False):
                 cls.add_error('Transaction is deleted but fail to'
                               'validate transactions, there might be'
                               'transaction without items')
                 return False
-            return True
+
+            try:
+                db.session.commit()
+                return True
+            except Exception as e:
+                cls.add_error(e)
+                db.session.rollback()
+                return False
         else:
             return False
 
     @classmethod
     def get_purchase_items(cls, id):
+        if INVENTORY_LOTS:
+            return db.session.query(func.sum(ItemLot.quantity).label('quantity'),
+                                    ItemLot.item_type_id,
+                                    func.max(ItemLot.purchase_price).label('purchase_price')) \
+                .filter(ItemLot.purchase_transaction_id == id) \
+                .group_by(ItemLot.item_type_id)
+
+        # one price per item type in a transaction, max only makes the query portable
         return db.session.query(func.count(Item.id).label('quantity'),
                                 Item.item_type_id,
-                                Item.purchase_price) \
+                                func.max(Item.purchase_price).label('purchase_price')) \
             .filter(Item.purchase_transaction_id == id) \
             .group_by(Item.item_type_id)
 
+    @classmethod
+    def get_item_type_ids(cls, id):
+        return [x.item_type_id for x in cls.get_purchase_items(id)]
+
     @classmethod
     def get_purchase_item_ids(cls, trans_id, item_type_id):
+        if INVENTORY_LOTS:
+            return [i[0] for i in db.session.query(ItemLot.id)
+                    .filter(ItemLot.purchase_transaction_id == trans_id)
+                    .filter(ItemLot.item_type_id == item_type_id).all()]
+
         return [i[0] for i in db.session.query(Item.id) \
             .filter(Item.purchase_transaction_id == trans_id) \
             .filter(Item.item_type_id == item_type_id).all()]
 
     @classmethod
+    @write_transaction
     def try_delete_all_purchase_items(cls, trans_id, commit=False):
         items = cls.get(trans_id).items
         try:
@@ -631,9 +1803,13 @@ class PurchaseTransaction(STModel):
 
 
     @classmethod
+    @write_transaction
     def try_add_purchase_items(cls, trans_id,
                                transaction_items, commit=False):
         try:
+            TransactionLine.touch(purchase_ids=[trans_id])
+
+            rows = []
             for trans_item in transaction_items:
                 # check if it contains all the data needed
                 # this is mainly for internal error from views to models
@@ -643,12 +1819,102 @@ class PurchaseTransaction(STModel):
                     cls.add_error('transaction item missing required keys')
                     raise Exception('transaction item missing required keys')
 
-                for i in range(trans_item['quantity']):
-                    item = Item(purchase_price=trans_item['purchase_price'],
-                                item_type_id=trans_item['item_type_id'],
-                                purchase_transaction_id=trans_id)
-                    db.session.add(item)
-                    db.session.flush()
+                ItemTypeStock.add(trans_item['item_type_id'],
+                                  purchased=max(trans_item['quantity'], 0))
+
+                if INVENTORY_LOTS:
+                    rows.append({'purchase_price': trans_item['purchase_price'],
+                                 'item_type_id': trans_item['item_type_id'],
+                                 'purchase_transaction_id': trans_id,
+                                 'quantity': trans_item['quantity']})
+                    continue
+
+                # every unit of the line has identical values,
+                # so the same dict can be repeated for executemany
+                row = {'purchase_price': trans_item['purchase_price'],
+                       'item_type_id': trans_item['item_type_id'],
+                       'purchase_transaction_id': trans_id}
+                rows.extend([row] * trans_item['quantity'])
+
+            if INVENTORY_LOTS:
+                ItemLot.bulk_insert(cls.merge_lot_rows(rows))
+            else:
+                Item.bulk_insert(rows)
+
+            if commit:
+                db.session.commit()
+            return True
+        except Exception as e:
+            cls.add_error(e)
+            db.session.rollback()
+            return False
+
+    @classmethod
+    def merge_lot_rows(cls, rows):
+        """
+        Merge lines with the same item type and price into one lot
+        """
+        lots = {}
+        for row in rows:
+            if row['quantity'] <= 0:
+                continue
+
+            key = (row['purchase_transaction_id'], row['item_type_id'], row['purchase_price'])
+            if key in lots:
+                lots[key]['quantity'] += row['quantity']
+            else:
+                lots[key] = dict(row)
+
+        for lot in lots.values():
+            lot['remaining'] = lot['quantity']
+        return list(lots.values())
+
+    @classmethod
+    def try_edit_purchase_lots(cls, trans_id, transaction_items, commit=False):
+        """
+        Lot version of try_edit_purchase_items,
+        all lots of a line are merged into its first lot
+        and the quantity cannot go below what has been sold
+        """
+        new_items = []
+        try:
+            ItemTypeStock.touch(cls.get_item_type_ids(trans_id))
+            ItemTypeStock.touch(x['item_type_id'] for x in transaction_items)
+            # removed and repriced items change the lines of their sales too
+            TransactionLine.touch([trans_id],
+                                  get_item_transaction_ids(purchase_transaction_id=trans_id)[1])
+
+            for transaction_item in transaction_items:
+                ids = utils.map_csv_params(transaction_item['ids'], int) \
+                    if transaction_item['ids'] else []
+
+                if not ids:
+                    new_items.append(transaction_item)
+                    continue
+
+                lot_id, merged_ids = ids[0], ids[1:]
+                if merged_ids:
+                    LotAllocation.query \
+                        .filter(LotAllocation.lot_id.in_(merged_ids)) \
+                        .update({LotAllocation.lot_id: lot_id}, synchronize_session=False)
+                    ItemLot.query \
+                        .filter(ItemLot.id.in_(merged_ids)) \
+                        .delete(synchronize_session=False)
+
+                ItemLot.query.filter(ItemLot.id == lot_id) \
+                    .update({ItemLot.item_type_id: transaction_item['item_type_id'],
+                             ItemLot.purchase_price: transaction_item['purchase_price'],
+                             ItemLot.quantity: transaction_item['quantity']},
+                            synchronize_session=False)
+                ItemLot.refresh_remaining([lot_id])
+
+                if db.session.query(exists().where((ItemLot.id == lot_id) &
+                                                   (ItemLot.remaining < 0))).scalar():
+                    cls.add_error('Quantity cannot be less than the sold quantity')
+                    raise Exception('Quantity cannot be less than the sold quantity')
+
+            if new_items and not cls.try_add_purchase_items(trans_id, new_items):
+                return False
 
             if commit:
                 db.session.commit()
@@ -658,45 +1924,85 @@ class PurchaseTransaction(STModel):
             db.session.rollback()
             return False
 
+    @classmethod
+    @write_transaction
+    def try_edit(cls, id, transaction_items, **fields):
+        """
+        Edit the items (see try_edit_purchase_items) and set
+        the fields of the transaction in one commit
+        """
+        if not cls.try_edit_purchase_items(id, transaction_items, False):
+            return False
+
+        try:
+            trans = cls.get(id)
+            for name, value in fields.items():
+                setattr(trans, name, value)
+            db.session.commit()
+            return True
+        except Exception as e:
+            cls.add_error(e)
+            db.session.rollback()
+            return False
+
     # problem, if you delete everything and add everything
     # it will affect the sale transaction
     # that's why now it is going to check whether it should add
     # or delete item for the existing transaction
     @classmethod
+    @write_transaction
     def try_edit_purchase_items(cls, trans_id, transaction_items, commit=False):
-        for transaction_item in transaction_items:
-            ids = list(map(int, transaction_item['ids'].split(',')))
-
-            # update every ids until reaches total of new qty
-            update_ids = ids[:transaction_item['quantity']]
-            for id in update_ids:
-                item = Item.get(id)
-                item.item_type_id = transaction_item['item_type_id']
-                item.purchase_price = transaction_item['purchase_price']
-                db.session.add(item)
-                db.session.flush()
-                # flash('updated ids: {}'.format(id))
-
-            # discard extra id after new qty in case new qty < old qty
-            delete_ids = ids[transaction_item['quantity']:]
-            for id in delete_ids:
-                item = Item.get(id)
-                db.session.delete(item)
-                db.session.flush()
-                # flash('deleted ids: {}'.format(id))
+        if INVENTORY_LOTS:
+            return cls.try_edit_purchase_lots(trans_id, transaction_items, commit)
 
-            # get new qty if total new qty is more than previous item
-            new_qty = max(0, transaction_item['quantity'] - len(ids))
-            if new_qty > 0:
-                # flash('new qty: {}'.format(new_qty))
-                items = transaction_item.copy()
-                items['quantity'] = new_qty
-                if not cls.try_add_purchase_items(trans_id, [items]):
-                    return False
+        new_items = []
+        try:
+            ItemTypeStock.touch(cls.get_item_type_ids(trans_id))
+            ItemTypeStock.touch(x['item_type_id'] for x in transaction_items)
+            # removed and repriced items change the lines of their sales too
+            TransactionLine.touch([trans_id],
+                                  get_item_transaction_ids(purchase_transaction_id=trans_id)[1])
+
+            for transaction_item in transaction_items:
+                # new line in the form does not have ids yet
+                ids = utils.map_csv_params(transaction_item['ids'], int) \
+                    if transaction_item['ids'] else []
+
+                # only items of this transaction can be edited
+                line_items = Item.query.filter(Item.purchase_transaction_id == trans_id)
+
+                # update every ids until reaches total of new qty
+                update_ids = ids[:transaction_item['quantity']]
+                if update_ids:
+                    line_items.filter(filter_ids(Item.id, update_ids)) \
+                        .update({Item.item_type_id: transaction_item['item_type_id'],
+                                 Item.purchase_price: transaction_item['purchase_price']},
+                                synchronize_session=False)
+
+                # discard extra id after new qty in case new qty < old qty
+                delete_ids = ids[transaction_item['quantity']:]
+                if delete_ids:
+                    line_items.filter(filter_ids(Item.id, delete_ids)) \
+                        .delete(synchronize_session=False)
+
+                # get new qty if total new qty is more than previous item
+                new_qty = max(0, transaction_item['quantity'] - len(ids))
+                if new_qty > 0:
+                    items = transaction_item.copy()
+                    items['quantity'] = new_qty
+                    new_items.append(items)
+
+            # insert the extra quantity of every line in one go
+            if new_items and not cls.try_add_purchase_items(trans_id, new_items):
+                return False
 
-        if commit:
-            db.session.commit()
-        return True
+            if commit:
+                db.session.commit()
+            return True
+        except Exception as e:
+            cls.add_error(e)
+            db.session.rollback()
+            return False
 
         #     cls.add_error('testing editing purchase items')
         #     return False
@@ -714,11 +2020,13 @@ class PurchaseTransaction(STModel):
 class SaleTransaction(STModel):
     id = db.Column(db.Integer, primary_key=True)
     items = db.relationship('Item', backref='sale_transaction', lazy='dynamic')
+    allocations = db.relationship('LotAllocation', backref='sale_transaction', lazy='dynamic',
+                                  cascade='save-update, merge, delete')
     transaction_date = db.Column(db.DateTime, index=True, nullable=False)
     delivery_fee = db.Column(db.Integer, index=True)
-    customer_id = db.Column(db.Integer, db.ForeignKey('customer.id'), nullable=False)
-    courier_id = db.Column(db.Integer, db.ForeignKey('courier.id'))
-    transaction_medium_id = db.Column(db.Integer, db.ForeignKey('transaction_medium.id'))
+    customer_id = db.Column(db.Integer, db.ForeignKey('customer.id'), index=True, nullable=False)
+    courier_id = db.Column(db.Integer, db.ForeignKey('courier.id'), index=True)
+    transaction_medium_id = db.Column(db.Integer, db.ForeignKey('transaction_medium.id'), index=True)
     notes = db.Column(db.String(NOTES_LENGTH))
 
     def __init__(self, transaction_date=None, customer_id=None,
@@ -739,71 +2047,128 @@ class SaleTransaction(STModel):
         self.notes = notes
 
     @utils.classproperty
-    def total(cls):
-        # there are two ways doing this same as purchase transaction
-        q = db.session.query(func.count(Item.id)) \
-            .filter(Item.sale_transaction_id != None) \
-            .group_by(Item.sale_transaction_id, Item.item_type_id)
-        return len(q.all())
+    def count_table(cls):
+        return TransactionLine.__table__.name
 
     @classmethod
-    def get_list(cls, page_num=DEFAULT_PAGE_NUMBER,
-                 list_per_page=DEFAULT_POSTS_PER_PAGE,
-                 include_header=True,
-                 order_by=None, ids=None, year=None, month=None, day=None):
-
-        qty_label = 'quantity'
-        individual_price_label = 'sale_price_(each)'
-        total_sale_price_label = 'total_sale_price'
-        total_purchase_price_label = 'total_purchase_price'
-        profit_label = 'profit'
-        delivery_fee_label = 'delivery_fee'
+    def count_query(cls, ids=None, year=None, month=None, day=None, date_from=None, date_to=None):
+        # count the lines with the same filters as the list
+        return cls.list_query(None, ids, year, month, day, date_from, date_to) \
+            .order_by(None) \
+            .with_entities(func.count(TransactionLine.id))
 
-        # initial query
-        q = db.session.query(Item.sale_transaction_id.label('sale_id'),
-                             ItemType.item_type,
-                             SaleTransaction.transaction_date,
-                             func.count(Item.id).label(qty_label),
-                             Item.sale_price.label(individual_price_label),
-                             func.sum(Item.sale_price).label(total_sale_price_label),
-                             func.sum(Item.purchase_price).label(total_purchase_price_label),
-                             func.sum(Item.profit).label(profit_label),
+    @classmethod
+    def line_query(cls, ids=None):
+        """
+        Lines (one per item type) of sale transactions (or every sale transaction if None)
+        counted from the items, source of TransactionLine
+        """
+        if INVENTORY_LOTS:
+            trans_id_column = LotAllocation.sale_transaction_id
+            item_type_id_column = ItemLot.item_type_id
+            q = db.session.query(LotAllocation.sale_transaction_id.label('transaction_id'),
+                                 ItemLot.item_type_id.label('item_type_id'),
+                                 func.sum(LotAllocation.quantity).label('quantity'),
+                                 func.max(LotAllocation.sale_price).label('price'),
+                                 func.sum(LotAllocation.quantity * LotAllocation.sale_price)
+                                 .label('total_price'),
+                                 func.sum(LotAllocation.quantity * ItemLot.purchase_price)
+                                 .label('total_purchase_price'),
+                                 func.sum(LotAllocation.quantity *
+                                          (LotAllocation.sale_price - ItemLot.purchase_price))
+                                 .label('profit')
+                                 ).join(ItemLot)
+        else:
+            trans_id_column = Item.sale_transaction_id
+            item_type_id_column = Item.item_type_id
+            q = db.session.query(Item.sale_transaction_id.label('transaction_id'),
+                                 Item.item_type_id.label('item_type_id'),
+                                 func.count(Item.id).label('quantity'),
+                                 func.max(Item.sale_price).label('price'),
+                                 func.sum(Item.sale_price).label('total_price'),
+                                 func.sum(Item.purchase_price).label('total_purchase_price'),
+                                 func.sum(Item.profit).label('profit'))
+
+        if ids is not None:
+            q = q.filter(filter_ids(trans_id_column, ids))
+
+        # outer join for optional,
+        # every selected column is grouped or aggregated (see PurchaseTransaction.line_query)
+        return q.add_columns(literal(True).label('is_sale'),
+                             ItemType.item_type.label('item_type'),
+                             SaleTransaction.transaction_date.label('transaction_date'),
                              Customer.name.label('customer'),
                              TransactionMedium.name.label('medium'),
                              Courier.name.label('courier'),
-                             SaleTransaction.delivery_fee.label(delivery_fee_label),
-                             SaleTransaction.notes
-                             )
+                             SaleTransaction.delivery_fee.label('delivery_fee'),
+                             SaleTransaction.notes.label('notes')) \
+            .join(ItemType, SaleTransaction, PurchaseTransaction, Customer) \
+            .outerjoin(Courier, TransactionMedium) \
+            .group_by(trans_id_column, item_type_id_column,
+                      ItemType.item_type, SaleTransaction.transaction_date,
+                      Customer.name, TransactionMedium.name, Courier.name,
+                      SaleTransaction.delivery_fee, SaleTransaction.notes)
+
+    @utils.classproperty
+    def list_keys(cls):
+        # item type breaks the tie between lines of the same transaction
+        return ((TransactionLine.transaction_date, 'transaction_date', True),
+                (TransactionLine.transaction_id, 'sale_id', False),
+                (TransactionLine.item_type, 'item_type', False))
+
+    @utils.classproperty
+    def list_tables(cls):
+        # total delivery fee is summed from the sale transactions
+        return sorted(set(get_query_tables(cls.list_query())) | {SaleTransaction.__tablename__})
+
+    @classmethod
+    def list_query(cls, order_by=None, ids=None, year=None, month=None, day=None,
+                   date_from=None, date_to=None):
+        q = db.session.query(TransactionLine.transaction_id.label('sale_id'),
+                             TransactionLine.item_type,
+                             TransactionLine.transaction_date,
+                             TransactionLine.quantity,
+                             TransactionLine.price.label('sale_price_(each)'),
+                             TransactionLine.total_price.label('total_sale_price'),
+                             TransactionLine.total_purchase_price,
+                             TransactionLine.profit,
+                             TransactionLine.customer,
+                             TransactionLine.medium,
+                             TransactionLine.courier,
+                             TransactionLine.delivery_fee,
+                             TransactionLine.notes) \
+            .filter(TransactionLine.is_sale == True)
 
         # filter based on param
         # id is only 1, so if it is not None just skip other filters
         if ids:
-            q = q.filter(Item.sale_transaction_id.in_(ids))
+            q = q.filter(TransactionLine.transaction_id.in_(ids))
         else:
-            # any is useful for checking ['']
-            # http://stackoverflow.com/questions/11191264/python-how-to-check-list-doest-contain-any-value
-
-            if year and any(year):
-                q = q.filter(extract('year', SaleTransaction.transaction_date).in_(year))
+            dates = filter_dates(TransactionLine.transaction_date, year, month, day, date_from, date_to,
+                                 TransactionLine.is_sale == True)
+            if dates is not None:
+                q = q.filter(dates)
 
-            if month and any(month):
-                q = q.filter(extract('month', SaleTransaction.transaction_date).in_(month))
+        return order_query(q, order_by, cls.list_keys)
 
-            if day and any(day):
-                q = q.filter(extract('day', SaleTransaction.transaction_date).in_(day))
+    @classmethod
+    @cached_list('list_tables')
+    def get_list(cls, page_num=DEFAULT_PAGE_NUMBER,
+                 list_per_page=DEFAULT_POSTS_PER_PAGE,
+                 include_header=True,
+                 order_by=None, cursor=None, ids=None, year=None, month=None, day=None,
+                 date_from=None, date_to=None):
 
-        # finishing query
-        # outer join for optional
-        q = q.join(ItemType, SaleTransaction, PurchaseTransaction,
-                   Customer) \
-            .outerjoin(Courier, TransactionMedium) \
-            .group_by(Item.sale_transaction_id, Item.item_type_id)
+        total_sale_price_label = 'total_sale_price'
+        total_purchase_price_label = 'total_purchase_price'
+        profit_label = 'profit'
+        delivery_fee_label = 'delivery_fee'
 
-        q = q.order_by(SaleTransaction.transaction_date.desc())
-        q = paginate_query(q, page_num, list_per_page)
+        q = cls.list_query(order_by, ids, year, month, day, date_from, date_to)
+        q = paginate_query(q, page_num, list_per_page, cursor, cls.list_keys if order_by is None else None)
 
         s_list = q.all()
-        column_names = tuple(x['name'] for x in q.column_descriptions)
+        column_names = utils.TableHeader(q.column_descriptions)
 
         # dynamically check where is total_price column is from column_names
         # add first column name 'TOTAL'
@@ -828,6 +2193,7 @@ class SaleTransaction(STModel):
         return s_list
 
     @classmethod
+    @write_transaction
     def try_add(cls, date=None, customer_id=None,
                 courier_id=None, delivery_fee=None,
                 transaction_medium_id=None, notes=None,
@@ -851,27 +2217,72 @@ class SaleTransaction(STModel):
             db.session.rollback()
             return False
 
+    @classmethod
+    @write_transaction
+    def try_delete(cls, id, **kwargs):
+        # sold items go back to stock (allocated quantity back to the lots)
+        # before the transaction is deleted
+        if not cls.try_delete_sale_items(id, False):
+            return False
+        return super().try_delete(id, **kwargs)
+
     @classmethod
     def get_sale_items(cls, id):
+        if INVENTORY_LOTS:
+            return db.session.query(func.sum(LotAllocation.quantity).label('quantity'),
+                                    ItemLot.item_type_id,
+                                    func.max(LotAllocation.sale_price).label('sale_price'),
+                                    func.min(LotAllocation.sale_price).label('min_sale_price')) \
+                .join(ItemLot) \
+                .filter(LotAllocation.sale_transaction_id == id) \
+                .group_by(ItemLot.item_type_id)
+
+        # max is the price of the item type, min only differs from it when
+        # lines of the item type had different prices
         return db.session.query(func.count(Item.id).label('quantity'),
                                 Item.item_type_id,
-                                Item.sale_price) \
+                                func.max(Item.sale_price).label('sale_price'),
+                                func.min(Item.sale_price).label('min_sale_price')) \
+            .filter(Item.sale_transaction_id == id) \
+            .group_by(Item.item_type_id)
+
+    @classmethod
+    def get_item_type_ids(cls, id):
+        return [x.item_type_id for x in cls.get_sale_items(id)]
+
+    @classmethod
+    def get_sale_totals(cls, id):
+        """
+        (item_type_id, quantity, profit) of every item type in sale transaction
+        """
+        if INVENTORY_LOTS:
+            return db.session.query(ItemLot.item_type_id,
+                                    func.sum(LotAllocation.quantity),
+                                    func.sum(LotAllocation.quantity *
+                                             (LotAllocation.sale_price - ItemLot.purchase_price))) \
+                .select_from(LotAllocation) \
+                .join(ItemLot) \
+                .filter(LotAllocation.sale_transaction_id == id) \
+                .group_by(ItemLot.item_type_id)
+
+        return db.session.query(Item.item_type_id,
+                                func.count(Item.id),
+                                func.sum(Item.sale_price - Item.purchase_price)) \
             .filter(Item.sale_transaction_id == id) \
             .group_by(Item.item_type_id)
 
     @classmethod
+    @write_transaction
     def try_delete_sale_items(cls, trans_id, commit=False):
-        items = cls.get(trans_id).items
+        inventory_model = ItemLot if INVENTORY_LOTS else Item
         try:
+            ItemTypeStock.touch(cls.get_item_type_ids(trans_id))
+            TransactionLine.touch(sale_ids=[trans_id])
             # remove sale transaction id for the item
-            for item in items:
-                item.sale_transaction_id = None
-                db.session.add(item)
-                db.session.flush()
+            inventory_model.release(trans_id)
 
             if commit:
                 db.session.commit()
-                flash('commit deleting transaction item')
             return True
         except Exception as e:
             cls.add_error(e)
@@ -879,34 +2290,31 @@ class SaleTransaction(STModel):
             return False
 
     @classmethod
+    @write_transaction
     def try_add_sale_items(cls, trans_id, transaction_items, commit=False):
         try:
+            TransactionLine.touch(sale_ids=[trans_id])
+
             for trans_item in transaction_items:
-                if not ('item_type_id' in trans_item or
-                                'quantity' in trans_item or
-                                'sale_price' in trans_item):
+                if not ('item_type_id' in trans_item and
+                        'quantity' in trans_item and
+                        'sale_price' in trans_item):
                     cls.add_error('transaction item missing required keys')
                     raise Exception('transaction item missing required keys')
 
-                # get items FIFO models
-                items = Item.query.join(PurchaseTransaction) \
-                    .filter(Item.sale_transaction_id == None) \
-                    .filter(Item.item_type_id == trans_item['item_type_id']) \
-                    .order_by(PurchaseTransaction.transaction_date, Item.id) \
-                    .limit(trans_item['quantity'])
-
-                # the quantity input is more than available items
-                # this one is internal error
-                if trans_item['quantity'] > items.count():
+                # claim items with FIFO method
+                inventory_model = ItemLot if INVENTORY_LOTS else Item
+                if not inventory_model.allocate(trans_id, trans_item['item_type_id'],
+                                                trans_item['quantity'], trans_item['sale_price']):
+                    # the quantity input is more than available items
+                    # this one is internal error
                     cls.add_error('The total input is exceeding total stock')
                     raise Exception('The total input is exceeding total stock')
 
-                # for each item add sale transaction field
-                for it in items:
-                    it.sale_price = trans_item['sale_price']
-                    it.sale_transaction_id = trans_id
-                    db.session.add(it)
-                    db.session.flush()
+            item_type_ids = set(x['item_type_id'] for x in transaction_items)
+            for item_type_id, quantity, profit in cls.get_sale_totals(trans_id):
+                if item_type_id in item_type_ids:
+                    ItemTypeStock.add(item_type_id, sold=quantity, profit=profit or 0)
 
             if commit:
                 db.session.commit()
@@ -917,14 +2325,362 @@ class SaleTransaction(STModel):
             db.session.rollback()
             return False
 
+    @classmethod
+    @write_transaction
+    def try_edit(cls, id, transaction_items, **fields):
+        """
+        Edit the items (see try_edit_sale_items) and set
+        the fields of the transaction in one commit
+        """
+        if not cls.try_edit_sale_items(id, transaction_items, False):
+            return False
+
+        try:
+            trans = cls.get(id)
+            for name, value in fields.items():
+                setattr(trans, name, value)
+            db.session.commit()
+            return True
+        except Exception as e:
+            cls.add_error(e)
+            db.session.rollback()
+            return False
+
     # TODO: Problem with total stock in the form
     @classmethod
+    @write_transaction
     def try_edit_sale_items(cls, trans_id, transaction_items, commit=False):
-        if cls.try_delete_sale_items(trans_id, False) and \
-                cls.try_add_sale_items(trans_id, transaction_items, False):
+        """
+        Edit sale items by the difference with the current allocation,
+        only the added quantity of an item type is claimed and
+        only the removed quantity is released, the rest stays untouched
+        """
+        inventory_model = ItemLot if INVENTORY_LOTS else Item
+        try:
+            sale_items = cls.get_sale_items(trans_id).all()
+            current = {x.item_type_id: x.quantity for x in sale_items}
+            # (min, max) sale price, they differ when lines had different prices
+            current_prices = {x.item_type_id: (x.min_sale_price, x.sale_price) for x in sale_items}
+            ItemTypeStock.touch(current)
+            ItemTypeStock.touch(x['item_type_id'] for x in transaction_items)
+            TransactionLine.touch(sale_ids=[trans_id])
+
+            # group lines by item type
+            lines = {}
+            for trans_item in transaction_items:
+                if not ('item_type_id' in trans_item and
+                        'quantity' in trans_item and
+                        'sale_price' in trans_item):
+                    cls.add_error('transaction item missing required keys')
+                    raise Exception('transaction item missing required keys')
+
+                lines.setdefault(trans_item['item_type_id'], []).append(trans_item)
+
+            # item types removed from the transaction
+            for item_type_id in current:
+                if item_type_id not in lines:
+                    inventory_model.release(trans_id, item_type_id)
+
+            new_items = []
+            for item_type_id, type_lines in lines.items():
+                prices = set(x['sale_price'] for x in type_lines)
+
+                # lines of the same item type with different prices
+                # cannot be diffed, so allocate the item type again
+                if len(prices) > 1:
+                    inventory_model.release(trans_id, item_type_id)
+                    new_items.extend(type_lines)
+                    continue
+
+                sale_price = prices.pop()
+                delta = sum(x['quantity'] for x in type_lines) - current.get(item_type_id, 0)
+
+                if current.get(item_type_id) and \
+                        current_prices[item_type_id] != (sale_price, sale_price):
+                    inventory_model.reprice(trans_id, item_type_id, sale_price)
+
+                if delta < 0:
+                    inventory_model.release(trans_id, item_type_id, -delta)
+                elif delta > 0:
+                    new_items.append({'item_type_id': item_type_id,
+                                      'quantity': delta,
+                                      'sale_price': sale_price})
+
+            if not cls.try_add_sale_items(trans_id, new_items, False):
+                return False
+
             if commit:
                 db.session.commit()
             return True
-        else:
+        except Exception as e:
+            cls.add_error(e)
             db.session.rollback()
-            return False
\ No newline at end of file
+            return False
+
+
+class TransactionLine(STModel):
+    """
+    One row per purchase or sale transaction and item type with the
+    quantity, prices, profit and names shown by the transaction list views,
+    so they page over this table instead of grouping the items.
+    Transactions touched in a session (bulk item statements touch them
+    explicitly, orm changes are picked up after flush) get their lines
+    counted again right before the commit
+    """
+    __table_args__ = (db.Index('ix_transaction_line_kind_date', 'is_sale', 'transaction_date'),
+                      db.Index('ix_transaction_line_kind_transaction', 'is_sale', 'transaction_id'))
+
+    id = db.Column(db.Integer, primary_key=True)
+    # no foreign keys, the lines of a deleted transaction are removed on commit
+    is_sale = db.Column(db.Boolean, nullable=False)
+    transaction_id = db.Column(db.Integer, nullable=False)
+    item_type_id = db.Column(db.Integer, index=True, nullable=False)
+    item_type = db.Column(db.String(NAME_LENGTH))
+    transaction_date = db.Column(db.DateTime, nullable=False)
+    quantity = db.Column(db.Integer, nullable=False)
+    price = db.Column(db.Integer)
+    total_price = db.Column(db.Integer)
+    total_purchase_price = db.Column(db.Integer)
+    profit = db.Column(db.Integer)
+    supplier = db.Column(db.String(NAME_LENGTH))
+    customer = db.Column(db.String(NAME_LENGTH))
+    medium = db.Column(db.String(NAME_LENGTH))
+    courier = db.Column(db.String(NAME_LENGTH))
+    delivery_fee = db.Column(db.Integer)
+    notes = db.Column(db.String(NOTES_LENGTH))
+
+    @classmethod
+    def get_pending(cls, session=None):
+        info = (session or db.session()).info
+        return info.setdefault('transaction_line', {'purchase': set(),
+                                                    'sale': set(),
+                                                    'supplier': set(),
+                                                    'customer': set(),
+                                                    'courier': set(),
+                                                    'medium': set(),
+                                                    'item_type': set()})
+
+    @classmethod
+    def touch(cls, purchase_ids=(), sale_ids=(), session=None):
+        """
+        Mark purchase and sale transactions to be counted again,
+        the views pass ids from the url and form as strings
+        """
+        pending = cls.get_pending(session)
+        pending['purchase'].update(int(x) for x in purchase_ids if x is not None)
+        pending['sale'].update(int(x) for x in sale_ids if x is not None)
+
+    @classmethod
+    def touch_objects(cls, session, objects):
+        """
+        Mark transactions of changed orm objects to be counted again,
+        renamed names are resolved to their transactions on commit
+        """
+        pending = cls.get_pending(session)
+        names = {Supplier: 'supplier', Customer: 'customer', Courier: 'courier',
+                 TransactionMedium: 'medium', ItemType: 'item_type'}
+
+        for obj in objects:
+            if isinstance(obj, PurchaseTransaction):
+                cls.touch(purchase_ids=[obj.id], session=session)
+            elif isinstance(obj, SaleTransaction):
+                cls.touch(sale_ids=[obj.id], session=session)
+            elif isinstance(obj, Item):
+                cls.touch([obj.purchase_transaction_id], [obj.sale_transaction_id], session)
+            elif isinstance(obj, ItemLot):
+                cls.touch(purchase_ids=[obj.purchase_transaction_id], session=session)
+            elif isinstance(obj, LotAllocation):
+                cls.touch(sale_ids=[obj.sale_transaction_id], session=session)
+            elif type(obj) in names and obj.id is not None:
+                pending[names[type(obj)]].add(obj.id)
+
+    @classmethod
+    def refresh(cls, purchase_ids=None, sale_ids=None):
+        """
+        Count the lines of transactions (or every transaction if both are None) from the items
+        """
+        refresh_all = purchase_ids is None and sale_ids is None
+
+        for is_sale, ids, model in ((False, purchase_ids, PurchaseTransaction),
+                                    (True, sale_ids, SaleTransaction)):
+            q = TransactionLine.query.filter(TransactionLine.is_sale == is_sale)
+
+            if not refresh_all:
+                if not ids:
+                    continue
+                q = q.filter(filter_ids(TransactionLine.transaction_id, ids))
+
+            lines = model.line_query(None if refresh_all else ids)
+            q.delete(synchronize_session=False)
+            db.session.execute(TransactionLine.__table__.insert().from_select(
+                [x['name'] for x in lines.column_descriptions], lines.statement))
+
+    @classmethod
+    def apply_pending(cls, session):
+        # flush first so the queries below don't add to the pending set
+        session.flush()
+        pending = session.info.pop('transaction_line', None)
+        if not pending:
+            return
+
+        purchase_ids = pending['purchase']
+        sale_ids = pending['sale']
+
+        if pending['supplier']:
+            purchase_ids.update(x[0] for x in db.session.query(PurchaseTransaction.id)
+                                .filter(filter_ids(PurchaseTransaction.supplier_id, pending['supplier'])))
+
+        for column, ids in ((SaleTransaction.customer_id, pending['customer']),
+                            (SaleTransaction.courier_id, pending['courier']),
+                            (SaleTransaction.transaction_medium_id, pending['medium'])):
+            if ids:
+                sale_ids.update(x[0] for x in db.session.query(SaleTransaction.id)
+                                .filter(filter_ids(column, ids)))
+
+        if pending['item_type']:
+            for is_sale, trans_id in db.session.query(TransactionLine.is_sale,
+                                                      TransactionLine.transaction_id) \
+                    .filter(filter_ids(TransactionLine.item_type_id, pending['item_type'])):
+                (sale_ids if is_sale else purchase_ids).add(trans_id)
+
+        cls.refresh(purchase_ids, sale_ids)
+
+
+@event.listens_for(SignallingSession, 'after_flush')
+def touch_transaction_lines(session, flush_context):
+    TransactionLine.touch_objects(session, list(session.new) + list(session.dirty) + list(session.deleted))
+
+
+@event.listens_for(SignallingSession, 'before_commit')
+def apply_transaction_lines(session):
+    TransactionLine.apply_pending(session)
+
+
+@event.listens_for(SignallingSession, 'after_soft_rollback')
+def discard_transaction_lines(session, previous_transaction):
+    session.info.pop('transaction_line', None)
+
+
+class CacheVersion(STModel):
+    """
+    Data version of every table, bumped with every commit that wrote
+    to the table (orm flush, bulk and core statements, see
+    track_written_tables) so data cached or sent from an older
+    version (form choice lists, list page etags) can be detected
+    by every worker process
+    """
+    name = db.Column(db.String(NAME_LENGTH), primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+
+    @classmethod
+    def get_versions(cls):
+        """
+        {table name: version}, read once per request
+        """
+        versions = getattr(g, 'cache_versions', None) if has_app_context() else None
+        if versions is None:
+            versions = dict(db.session.query(CacheVersion.name, CacheVersion.version))
+            if has_app_context():
+                g.cache_versions = versions
+        return versions
+
+    @classmethod
+    def get_version(cls, name):
+        return cls.get_versions().get(name, 0)
+
+    @classmethod
+    def apply_pending(cls, session):
+        # the written tables of a released savepoint (a write of the write
+        # queue group) are kept until the outer commit, which bumps them once
+        if session.transaction.nested:
+            return
+
+        # flush first, objects added right before commit are only flushed after this event
+        session.flush()
+        names = session.connection().info.get('written_tables', set()) - {CacheVersion.__tablename__}
+        if not names:
+            return
+
+        if db.engine.dialect.name == 'sqlite':
+            # the write holds the lock of the whole database anyway,
+            # bumping in the same commit costs no extra commit
+            cls.bump(session.connection(), names)
+        else:
+            # otherwise every writer of a table would wait for the version
+            # row until the commit of the previous one is flushed, they are
+            # bumped right after the commit in a short transaction instead
+            session.info.setdefault('cache_version_names', set()).update(names)
+
+        if has_app_context():
+            g.cache_versions = None
+
+    @classmethod
+    def bump(cls, conn, names):
+        table = CacheVersion.__table__
+
+        def update(name):
+            return conn.execute(table.update()
+                                .where(table.c.name == name)
+                                .values(version=table.c.version + 1)).rowcount
+
+        # the same order in every writer, so two writers never wait for each other
+        for name in sorted(names):
+            if update(name):
+                continue
+            try:
+                with conn.begin_nested():
+                    conn.execute(table.insert().values(name=name, version=1))
+            except exc.IntegrityError:
+                # a concurrent writer added the row since the update
+                update(name)
+
+    @classmethod
+    def bump_committed(cls, names):
+        """
+        Bump the versions of tables written by a commit which already ended
+        """
+        try:
+            with db.engine.begin() as conn:
+                # the row lock is released without waiting for the flush,
+                # a crash can only lose the bump of the latest commits
+                conn.execute('SET LOCAL synchronous_commit TO OFF')
+                cls.bump(conn, names)
+        except exc.DBAPIError:
+            # the data is committed, so the write must not fail (or be retried) here
+            logger.exception('CacheVersion bump failed tables=%s', ','.join(sorted(names)))
+
+
+@event.listens_for(SignallingSession, 'before_commit')
+def apply_cache_versions(session):
+    CacheVersion.apply_pending(session)
+
+
+@event.listens_for(SignallingSession, 'after_commit')
+def bump_committed_cache_versions(session):
+    # after_commit also fires when a savepoint is released
+    if not session.transaction.nested:
+        names = session.info.pop('cache_version_names', None)
+        if names:
+            CacheVersion.bump_committed(names)
+
+
+@event.listens_for(SignallingSession, 'after_rollback')
+def discard_cache_versions(session):
+    if not session.transaction.nested:
+        session.info.pop('cache_version_names', None)
+
+
+def get_query_tables(query):
+    """
+    Names of the tables query reads
+    """
+    return sorted(set(x.name for x in find_tables(query.statement)))
+
+
+class ImportCheckpoint(STModel):
+    """
+    Last committed line of a file imported by `manage.py import`
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    source = db.Column(db.String(ADDRESS_LENGTH), unique=True, nullable=False)
+    line = db.Column(db.Integer, nullable=False)
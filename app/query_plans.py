@@ -0,0 +1,180 @@
+"""
+Index maintenance and EXPLAIN QUERY PLAN checks of the hot model queries
+used by `python manage.py create_indexes` and `python manage.py check_query_plans`
+
+The checks run against the configured database, a query fails when
+its plan reads a whole table (SCAN without an index) instead of
+searching an index, which usually means an index is missing or a
+change made the query unable to use it. A scan of the first page
+(LIMIT without OFFSET) in the order of the table needs no sort and
+stops after the page, so it passes.
+PostgreSQL plans small tables with sequential scans whatever the
+indexes, so there the queries are planned with enable_seqscan off
+and a Seq Scan, or an index scan which filters the whole index,
+is left only where no index can serve the query
+"""
+import re
+from datetime import datetime
+from sqlalchemy import inspect
+from app import db, models
+import config
+
+# SEARCH uses an index, SCAN without USING reads every row of the table
+FULL_SCAN = re.compile(r'^SCAN (?:TABLE )?(\w+)(?!.*\bUSING\b)')
+# a PostgreSQL plan node, property lines like Filter: follow their node
+PLAN_NODE = re.compile(r'^\s*(?:->\s*)?([A-Z][\w ]*?)(?: using \w+)? on (\w+)')
+# the rows are sorted after they are all read
+SORTED = {'sqlite': re.compile(r'^USE TEMP B-TREE FOR (?:RIGHT PART OF )?ORDER BY'),
+          'postgresql': re.compile(r'^\s*(?:->\s*)?(?:Incremental )?Sort\b')}
+
+
+def create_missing_indexes():
+    """
+    Create the model indexes which the existing tables do not have yet,
+    create_all only creates indexes together with new tables
+    """
+    inspector = inspect(db.engine)
+    table_names = set(inspector.get_table_names())
+
+    created = []
+    for table in db.metadata.sorted_tables:
+        if table.name not in table_names:
+            continue
+
+        index_names = set(x['name'] for x in inspector.get_indexes(table.name))
+        for index in table.indexes:
+            if index.name not in index_names:
+                index.create(db.engine)
+                created.append(index.name)
+
+    return created
+
+
+def hot_queries():
+    """
+    (name, query) of the queries run by every list page and write path,
+    the ids are placeholders, only the plan matters
+    """
+    item_model = models.ItemLot if config.INVENTORY_LOTS else models.Item
+    per_page = config.DEFAULT_POSTS_PER_PAGE
+    queries = [
+        ('fifo stock lookup', item_model.fifo_query(1)),
+        ('purchase items', models.PurchaseTransaction.get_purchase_items(1)),
+        ('sale items', models.SaleTransaction.get_sale_items(1)),
+        ('sale totals', models.SaleTransaction.get_sale_totals(1)),
+        ('purchase lines', models.PurchaseTransaction.line_query([1])),
+        ('sale lines', models.SaleTransaction.line_query([1])),
+        ('supplier purchases', models.PurchaseTransaction.query
+         .filter(models.PurchaseTransaction.supplier_id == 1)),
+        ('customer sales', models.SaleTransaction.query
+         .filter(models.SaleTransaction.customer_id == 1)),
+        ('courier sales', models.SaleTransaction.query
+         .filter(models.SaleTransaction.courier_id == 1)),
+        ('medium sales', models.SaleTransaction.query
+         .filter(models.SaleTransaction.transaction_medium_id == 1)),
+        ('item stock page', models.paginate_query(models.Item.stock_query(), 1, per_page)),
+        ('item stock next page', models.Item.stock_query()
+         .filter(models.seek_filter(models.Item.stock_keys, [1]))
+         .limit(per_page)),
+    ]
+
+    for model in (models.PurchaseTransaction, models.SaleTransaction):
+        name = model.__tablename__.replace('_', ' ')
+        last_row = [datetime.now(), 1, '']
+        queries += [
+            (name + ' list page', models.paginate_query(model.list_query(), 1, per_page)),
+            (name + ' list next page', model.list_query()
+             .filter(models.seek_filter(model.list_keys, last_row))
+             .limit(per_page)),
+            (name + ' list by month', model.list_query(year=[datetime.now().year], month=[1])),
+            (name + ' count', model.count_query()),
+        ]
+
+    if config.INVENTORY_LOTS:
+        queries += [
+            ('lot allocations', models.LotAllocation.query
+             .filter(models.LotAllocation.lot_id == 1)),
+            ('sale allocations', models.ItemLot.get_allocations(1, 1)),
+        ]
+
+    return queries
+
+
+def explain(query):
+    """
+    Detail lines of the query plan of query
+    """
+    compiled = query.statement.compile(dialect=db.engine.dialect)
+    conn = db.session.connection()
+
+    if db.engine.dialect.name == 'postgresql':
+        # until the end of the transaction, check_query_plans rolls it back
+        conn.execute('SET LOCAL enable_seqscan = off')
+        return [row[0] for row in conn.execute('EXPLAIN ' + str(compiled), compiled.params)]
+
+    params = tuple(compiled.params[name] for name in compiled.positiontup)
+    rows = conn.execute('EXPLAIN QUERY PLAN ' + str(compiled), params)
+    return [row['detail'] for row in rows]
+
+
+def is_first_page_in_order(query, details):
+    """
+    True if query stops after its LIMIT and its plan reads the rows
+    already in the order of the query, so a scan reads one page only
+    """
+    sorted_rows = SORTED[db.engine.dialect.name]
+    return query._limit is not None and not query._offset and \
+        not any(sorted_rows.match(x) for x in details)
+
+
+def check_query_plans(out=print):
+    """
+    Print the plan of every hot query and return the names of
+    the queries which scan a whole table
+    """
+    if db.engine.dialect.name not in SORTED:
+        out('Query plans are only checked on SQLite and PostgreSQL')
+        return []
+
+    table_names = set(db.metadata.tables)
+    failed = []
+
+    for name, query in hot_queries():
+        details = explain(query)
+        scanned = [x for x in scanned_tables(details) if x in table_names]
+        if scanned and is_first_page_in_order(query, details):
+            scanned = []
+
+        out('{}: {}'.format('FULL SCAN' if scanned else 'ok', name))
+        for detail in details:
+            out('    ' + detail)
+
+        if scanned:
+            failed.append(name)
+
+    db.session.rollback()
+    return failed
+
+
+def scanned_tables(details):
+    """
+    Names of the tables which the plan details read whole, on PostgreSQL a
+    Seq Scan or an index scan without an Index Cond which reads the whole
+    index and filters its rows
+    """
+    if db.engine.dialect.name == 'sqlite':
+        return [m.group(1) for m in map(FULL_SCAN.match, details) if m]
+
+    scanned = []
+    node = None
+    for detail in details + ['']:
+        m = PLAN_NODE.match(detail)
+        if m or not detail.strip() or detail.lstrip().startswith('->'):
+            if node and (node[0] == 'Seq Scan' or 'Index' in node[0] and node[2] and not node[3]):
+                scanned.append(node[1])
+            node = [m.group(1), m.group(2), False, False] if m else None
+        elif node and detail.lstrip().startswith('Filter:'):
+            node[2] = True
+        elif node and detail.lstrip().startswith('Index Cond:'):
+            node[3] = True
+    return scanned
@@ -0,0 +1,134 @@
+"""
+Result cache of the list views (STModel.get_list and Item.get_stock_list),
+see models.cached_list
+
+Entries are keyed by the call arguments together with the data version
+(CacheVersion) of every table the list reads, a write to any of those
+tables makes the entry unreachable, so entries never need an expiry time.
+Every worker process keeps the last LIST_CACHE_SIZE results in memory,
+LIST_CACHE_DIR adds a cache on the filesystem shared between the workers
+"""
+import hashlib
+import os
+import pickle
+import tempfile
+import threading
+from collections import OrderedDict
+import config
+
+FILE_SUFFIX = '.pickle'
+
+
+class MemoryCache(object):
+    """
+    Least recently used cache of at most size entries
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.entries:
+                return None
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+class FileCache(object):
+    """
+    One pickle file per entry in directory, shared between worker processes.
+    Entries of old versions are never read again,
+    `python manage.py clear_list_cache` removes them
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def get_path(self, key):
+        name = hashlib.sha1(repr(key).encode()).hexdigest()
+        return os.path.join(self.directory, name + FILE_SUFFIX)
+
+    def get(self, key):
+        try:
+            with open(self.get_path(key), 'rb') as f:
+                stored_key, value = pickle.load(f)
+        except Exception:
+            # missing, half written by an older version or unreadable,
+            # it is only a cache
+            return None
+
+        # the file name is a hash, make sure it is the same key
+        return value if stored_key == key else None
+
+    def set(self, key, value):
+        try:
+            # write a temporary file then rename it, so other workers
+            # never read a half written entry
+            with tempfile.NamedTemporaryFile(dir=self.directory, suffix='.tmp', delete=False) as f:
+                pickle.dump((key, value), f, pickle.HIGHEST_PROTOCOL)
+            os.replace(f.name, self.get_path(key))
+        except Exception:
+            pass
+
+    def clear(self):
+        for name in os.listdir(self.directory):
+            if name.endswith(FILE_SUFFIX) or name.endswith('.tmp'):
+                os.remove(os.path.join(self.directory, name))
+
+
+class TieredCache(object):
+    """
+    Read the caches in order, an entry found in a later cache
+    is copied into the earlier ones
+    """
+
+    def __init__(self, *caches):
+        self.caches = caches
+
+    def get(self, key):
+        for i, cache in enumerate(self.caches):
+            value = cache.get(key)
+            if value is not None:
+                for earlier in self.caches[:i]:
+                    earlier.set(key, value)
+                return value
+        return None
+
+    def set(self, key, value):
+        for cache in self.caches:
+            cache.set(key, value)
+
+    def clear(self):
+        for cache in self.caches:
+            cache.clear()
+
+
+def create_cache(size=config.LIST_CACHE_SIZE, directory=config.LIST_CACHE_DIR):
+    """
+    Cache configured by LIST_CACHE_SIZE and LIST_CACHE_DIR,
+    None if both are turned off
+    """
+    caches = []
+    if size:
+        caches.append(MemoryCache(size))
+    if directory:
+        caches.append(FileCache(directory))
+
+    if not caches:
+        return None
+    return caches[0] if len(caches) == 1 else TieredCache(*caches)
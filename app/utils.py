@@ -1,4 +1,7 @@
 import config
+import base64
+import json
+from datetime import datetime
 from flask import flash
 
 
@@ -14,6 +17,72 @@ def map_csv_params(csv, map_type=str):
         raise ValueError('Cannot convert into list of {} from your input\n{}'.format(map_type, e))
 
 
+def id_ranges(ids):
+    """
+    Compress ids into sorted inclusive (start, end) ranges
+    e.g. [3, 1, 2, 7, 9, 10] -> [(1, 3), (7, 7), (9, 10)]
+    """
+    ranges = []
+    for id in sorted(set(ids)):
+        if ranges and ranges[-1][1] + 1 == id:
+            ranges[-1][1] = id
+        else:
+            ranges.append([id, id])
+
+    return [tuple(r) for r in ranges]
+
+
+def merge_ranges(ranges):
+    """
+    Merge overlapping or touching half open (start, end) ranges
+    e.g. [(1, 3), (3, 5), (7, 8)] -> [(1, 5), (7, 8)]
+    """
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+
+    return [tuple(r) for r in merged]
+
+
+def parse_date(text, date_format='%Y-%m-%d'):
+    """
+    Datetime of text or None if it is empty or invalid
+    """
+    try:
+        return datetime.strptime(text.strip(), date_format)
+    except (AttributeError, ValueError):
+        return None
+
+
+def encode_cursor(page_num, per_page, values):
+    """
+    Opaque url safe cursor of a page: the page number and page size
+    it is valid for and the order key values of the last row before it
+    """
+    values = [{'datetime': x.isoformat()} if isinstance(x, datetime) else x for x in values]
+    data = json.dumps([page_num, per_page, values], separators=(',', ':'))
+    return base64.urlsafe_b64encode(data.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """
+    Reverse of encode_cursor, return (page number, page size, values)
+    or None if the cursor is invalid
+    """
+    try:
+        data = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        page_num, per_page, values = json.loads(data.decode())
+        values = [datetime.strptime(x['datetime'], '%Y-%m-%dT%H:%M:%S.%f' if '.' in x['datetime']
+                                    else '%Y-%m-%dT%H:%M:%S')
+                  if isinstance(x, dict) else x for x in values]
+        return page_num, per_page, values
+    except Exception:
+        return None
+
+
 def is_int(s):
     try:
         int(s)
@@ -22,6 +91,22 @@ def is_int(s):
         return False
 
 
+class TableHeader(tuple):
+    """
+    Header row of a table (the column names) which also keeps
+    the column types, so the table can pick a formatter per column
+    """
+    def __new__(cls, column_descriptions):
+        header = super().__new__(cls, (x['name'] for x in column_descriptions))
+        header.types = tuple(x['type'] for x in column_descriptions)
+        return header
+
+    def __reduce__(self):
+        # __new__ takes the column descriptions, pickle (the file cache
+        # of the lists) has to rebuild the header from them
+        return TableHeader, ([{'name': name, 'type': type_} for name, type_ in zip(self, self.types)],)
+
+
 class classproperty(property):
     """
     Property for class (static property)
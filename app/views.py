@@ -1,10 +1,19 @@
-from flask import render_template, flash, redirect, url_for, request
+from flask import render_template, flash, redirect, url_for, request, \
+    Response, stream_with_context, session, make_response
 from app import app, db, models, forms
 from datetime import datetime
+from decimal import Decimal
 from flask_paginate import Pagination
+from flask_wtf.csrf import generate_csrf
 from app import utils
 import config
 from collections import namedtuple
+from functools import wraps
+import csv
+import hashlib
+import io
+import json
+import time
 
 
 # TODO add safe redirect
@@ -75,16 +84,21 @@ def get_pagination(request, total, **kwargs):
         per_page = int(per_page) if utils.is_int(per_page) else config.DEFAULT_POSTS_PER_PAGE
         per_page_strict_int = per_page
 
+    # cursor is only valid for one page,
+    # the cursor of the next page is added by set_next_cursor
+    cursor = request.args.get(config.URL_CURSOR)
+    url = remove_url_param(request.url, config.URL_CURSOR)
+
     # make redirect link for href
     # there is no parameter
-    if '?' not in request.url:
-        href = request.url + '?' + config.URL_PAGE_NUM + '={0}'
+    if '?' not in url:
+        href = url + '?' + config.URL_PAGE_NUM + '={0}'
     # in case url ends with '?' without any parameter
-    elif request.url.endswith('?'):
-        href = request.url + config.URL_PAGE_NUM + '={0}'
+    elif url.endswith('?'):
+        href = url + config.URL_PAGE_NUM + '={0}'
     # there is parameter(s)
     else:
-        params = request.url.split('&')
+        params = url.split('&')
         page_param_found = False
 
         # for first param, it is merged with the url
@@ -129,12 +143,77 @@ def get_pagination(request, total, **kwargs):
     per_page_form = forms.PerPageForm(pagination.per_page)
     returned_pagination = namedtuple('returned_pagination',
                                      ['pagination', 'page_num',
-                                      'per_page', 'per_page_form'])
+                                      'per_page', 'per_page_form', 'cursor'])
 
     return returned_pagination(pagination=pagination,
                                page_num=page,
                                per_page=per_page,
-                               per_page_form=per_page_form)
+                               per_page_form=per_page_form,
+                               cursor=cursor)
+
+
+def remove_url_param(url, name):
+    if '?' not in url:
+        return url
+
+    base, query = url.split('?', 1)
+    params = [x for x in query.split('&') if x and not x.startswith(name + '=')]
+    return base + '?' + '&'.join(params) if params else base
+
+
+def set_next_cursor(pagination_set, list_keys, table):
+    """
+    Add the cursor of the next page to the page links so going to
+    the next page seeks after the last row of this page instead of
+    using offset, the other pages ignore it
+    """
+    cursor = models.get_next_cursor(list_keys, table,
+                                    pagination_set.page_num, pagination_set.per_page)
+    if cursor:
+        pagination_set.pagination.href += '&{}={}'.format(config.URL_CURSOR, cursor)
+
+
+def conditional_list(get_tables):
+    """
+    Answer 304 Not Modified to a GET when the etag of the page (url and data
+    versions of the tables from get_tables) matches the client's copy,
+    without running any of the list queries
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            # flashed messages have to be shown by the next rendered page
+            if request.method != 'GET' or session.get('_flashes'):
+                return view(*args, **kwargs)
+
+            etag = get_list_etag(get_tables())
+            if request.if_none_match.contains(etag):
+                response = Response(status=304)
+            else:
+                response = make_response(view(*args, **kwargs))
+
+            response.set_etag(etag)
+            # browser has to ask every time, but can reuse its copy
+            response.cache_control.private = True
+            response.cache_control.no_cache = True
+            return response
+        return wrapper
+    return decorator
+
+
+def get_list_etag(table_names):
+    versions = models.CacheVersion.get_versions()
+
+    # the page carries a csrf token, change the etag before the token expires.
+    # generate_csrf creates the session's token on the first page, which
+    # would otherwise only happen while rendering, after the etag is made
+    generate_csrf()
+    time_limit = app.config.get('WTF_CSRF_TIME_LIMIT', 3600)
+    csrf_period = int(time.time() // (time_limit // 2)) if time_limit else 0
+
+    key = [request.full_path, session['csrf_token'], csrf_period, config.INVENTORY_LOTS]
+    key += ['{}:{}'.format(x, versions.get(x, 0)) for x in table_names]
+    return hashlib.sha1(repr(key).encode()).hexdigest()
 
 
 def remove_table_redundancy(table, exception_index):
@@ -164,6 +243,32 @@ def flash_format(string, *args):
     flash(string.format(*args))
 
 
+def get_filter_params(request, ids=None):
+    """
+    Read transaction list filters from url params,
+    id from the url path (ids) takes priority over the other filters
+    """
+    if ids:
+        return {'ids': [ids]}
+
+    return {'ids': request.args.getlist(config.URL_ID),
+            'year': request.args.getlist(config.URL_YEAR),
+            'month': request.args.getlist(config.URL_MONTH),
+            'day': request.args.getlist(config.URL_DAY),
+            'date_from': request.args.get(config.URL_DATE_FROM),
+            'date_to': request.args.get(config.URL_DATE_TO)}
+
+
+def get_export_url(export_func):
+    """
+    Url of csv export keeping the current filter params
+    """
+    url = url_for(get_func_name(export_func))
+    if request.query_string:
+        url += '?' + request.query_string.decode()
+    return url
+
+
 # ----------
 # ADD Region
 # ----------
@@ -330,10 +435,11 @@ def edit_item_type(id=None):
     if request.method == 'POST':
         form.check_exist = False
         if form.validate_on_submit():
-            item_type.item_type = form.name_field.data
-            models.ItemType.update(item_type)
-            flash_format('Successfully edited {}', item_type.item_type)
-            return redirect(url_for(item_types.__name__))
+            if models.ItemType.update(id, item_type=form.name_field.data):
+                flash_format('Successfully edited {}', form.name_field.data)
+                return redirect(url_for(item_types.__name__))
+            else:
+                flash_format('Fail to edit item type: {}', models.ItemType.error)
 
     return render_template('edit/edit-item-type.html', form=form)
 
@@ -352,12 +458,13 @@ def edit_supplier(id=None):
 
     if request.method == 'POST':
         if form.validate_on_submit():
-            supplier.name = form.name.data
-            supplier.contact = form.contact.data
-            supplier.address = form.address.data
-            models.ItemType.update(supplier)
-            flash_format('Successfully edited {}', supplier.name)
-            return redirect(url_for(suppliers.__name__))
+            if models.Supplier.update(id, name=form.name.data,
+                                      contact=form.contact.data,
+                                      address=form.address.data):
+                flash_format('Successfully edited {}', form.name.data)
+                return redirect(url_for(suppliers.__name__))
+            else:
+                flash_format('Fail to edit supplier: {}', models.Supplier.error)
 
     return render_template('edit/edit-supplier.html', form=form)
 
@@ -376,12 +483,13 @@ def edit_customer(id=None):
 
     if request.method == 'POST':
         if form.validate_on_submit():
-            customer.name = form.name.data
-            customer.contact = form.contact.data
-            customer.address = form.address.data
-            models.ItemType.update(customer)
-            flash_format('Successfully edited {}', customer.name)
-            return redirect(url_for(customers.__name__))
+            if models.Customer.update(id, name=form.name.data,
+                                      contact=form.contact.data,
+                                      address=form.address.data):
+                flash_format('Successfully edited {}', form.name.data)
+                return redirect(url_for(customers.__name__))
+            else:
+                flash_format('Fail to edit customer: {}', models.Customer.error)
 
     return render_template('edit/edit-customer.html', form=form)
 
@@ -402,10 +510,11 @@ def edit_courier(id=None):
     if request.method == 'POST':
         form.check_exist = False
         if form.validate_on_submit():
-            courier.name = form.name_field.data
-            models.Courier.update(courier)
-            flash_format('Successfully edited {}', courier.name)
-            return redirect(url_for(couriers.__name__))
+            if models.Courier.update(id, name=form.name_field.data):
+                flash_format('Successfully edited {}', form.name_field.data)
+                return redirect(url_for(couriers.__name__))
+            else:
+                flash_format('Fail to edit courier: {}', models.Courier.error)
 
     return render_template('edit/edit-courier.html', form=form)
 
@@ -426,10 +535,12 @@ def edit_transaction_medium(id=None):
     if request.method == 'POST':
         form.check_exist = False
         if form.validate_on_submit():
-            tm.name = form.name_field.data
-            models.TransactionMedium.update(tm)
-            flash_format('Successfully edited {}', tm.name)
-            return redirect(url_for(transaction_mediums.__name__))
+            if models.TransactionMedium.update(id, name=form.name_field.data):
+                flash_format('Successfully edited {}', form.name_field.data)
+                return redirect(url_for(transaction_mediums.__name__))
+            else:
+                flash_format('Fail to edit transaction medium: {}',
+                             models.TransactionMedium.error)
 
     return render_template('edit/edit-transaction-medium.html', form=form)
 
@@ -470,19 +581,18 @@ def edit_purchase_transaction(id=None):
             form.transaction_items.append_entry(pt_item)
     else: # POST
         if form.validate_on_submit():
-            pt.transaction_date = datetime(form.yyyy.data, form.MM.data, form.dd.data,
-                                           form.HH.data, form.mm.data, form.ss.data)
-            pt.supplier_id = form.supplier_id.data
-            pt.notes = form.notes.data
-
             items = [{'purchase_price': x.purchase_price.data,
                       'item_type_id': x.item_type.data,
                       'quantity': x.quantity.data,
                       'ids': x.ids.data}
                      for x in form.transaction_items]
 
-            if models.PurchaseTransaction.try_edit_purchase_items(id, items):
-                models.PurchaseTransaction.update(pt)
+            fields = {'transaction_date': datetime(form.yyyy.data, form.MM.data, form.dd.data,
+                                                   form.HH.data, form.mm.data, form.ss.data),
+                      'supplier_id': form.supplier_id.data,
+                      'notes': form.notes.data}
+
+            if models.PurchaseTransaction.try_edit(id, items, **fields):
                 flash_format('Successfully edited purchase transaction')
                 return redirect(url_for(purchase_transactions.__name__))
             else:
@@ -530,27 +640,24 @@ def edit_sale_transaction(id=None):
             form.transaction_items.append_entry(st_item)
     else: # POST
         if form.validate_on_submit():
-            st.transaction_date = datetime(form.yyyy.data, form.MM.data, form.dd.data,
-                                           form.HH.data, form.mm.data, form.ss.data)
+            items = [{'item_type_id': x.item_stock.data,
+                      'quantity': x.quantity.data,
+                      'sale_price': x.sale_price.data}
+                     for x in form.transaction_items]
 
-            st.delivery_fee = form.delivery_fee.data
-            st.customer_id = form.customer_id.data
+            fields = {'transaction_date': datetime(form.yyyy.data, form.MM.data, form.dd.data,
+                                                   form.HH.data, form.mm.data, form.ss.data),
+                      'delivery_fee': form.delivery_fee.data,
+                      'customer_id': form.customer_id.data,
+                      'notes': form.notes.data}
 
             if form.courier_id.data != config.NULL_INTEGER:
-                st.courier_id = form.courier_id.data
+                fields['courier_id'] = form.courier_id.data
 
             if form.courier_id.data != config.NULL_INTEGER:
-                st.transaction_medium_id = form.transaction_medium_id.data
-
-            st.notes = form.notes.data
-
-            items = [{'item_type_id': x.item_stock.data,
-                      'quantity': x.quantity.data,
-                      'sale_price': x.sale_price.data}
-                     for x in form.transaction_items]
+                fields['transaction_medium_id'] = form.transaction_medium_id.data
 
-            if models.SaleTransaction.try_edit_sale_items(id, items):
-                models.SaleTransaction.update(st)
+            if models.SaleTransaction.try_edit(id, items, **fields):
                 flash_format('Successfully edited sale transaction')
                 return redirect(url_for(sale_transactions.__name__))
             else:
@@ -574,7 +681,9 @@ def render_basic_table_view(request=None,
                             record_name=None,
                             html_path=None,
                             delete_func=None,
-                            edit_func=None):
+                            edit_func=None,
+                            export_func=None,
+                            list_keys=None):
     if (not request or not get_table_func or
             not record_name or not html_path):
         # dont put total because sometimes there is no item
@@ -585,21 +694,26 @@ def render_basic_table_view(request=None,
                                     record_name=record_name)
 
     table_list = get_table_func(page_num=pagination_set.page_num,
-                                list_per_page=pagination_set.per_page)
+                                list_per_page=pagination_set.per_page,
+                                cursor=pagination_set.cursor)
 
-    # if there is delete func provided,
-    # add new column for delete
-    if delete_func and edit_func:
-        add_extra_column(table_list, delete_func, edit_func)
+    if list_keys:
+        set_next_cursor(pagination_set, list_keys, table_list)
 
     # XOR operator
     if bool(delete_func) ^ bool(edit_func):
         raise ValueError('If you provide delete_func for extra column '
                          'it should be accompanied with edit_func and vice versa')
 
+    # if there is delete func provided,
+    # the table renders edit and delete buttons for every row
+    row_actions = get_row_actions(delete_func, edit_func) if delete_func else None
+
     return render_template(html_path, table=table_list,
                            pagination=pagination_set.pagination,
-                           per_page_form=pagination_set.per_page_form)
+                           per_page_form=pagination_set.per_page_form,
+                           row_actions=row_actions,
+                           export_url=get_export_url(export_func) if export_func else None)
 
 
 def get_func_name(func):
@@ -611,37 +725,32 @@ def get_func_name(func):
         raise TypeError("func param should only be function or string")
 
 
-def add_extra_column(table_list, delete_func, edit_func):
-    delete_func = get_func_name(delete_func)
-    edit_func = get_func_name(edit_func)
-
-    for i in range(len(table_list)):
-        if (isinstance(table_list[i][0], int)):
-            delete_form = forms.IdForm(table_list[i][0],
-                                       url_for(delete_func))
-            edit_form = forms.IdForm(table_list[i][0],
-                                     url_for(edit_func))
-
-            delete_template = render_template('form_templates/delete-form.html',
-                                              delete_form=delete_form)
-            edit_template = render_template('form_templates/edit-form.html',
-                                            edit_form=edit_form)
-
-            table_list[i] += (('{}{}'.format(edit_template, delete_template)),)
-        else:
-            table_list[i] += ('',)
+def get_row_actions(delete_func, edit_func):
+    """
+    Urls and csrf token of the edit and delete buttons,
+    built once per page and shared by every row of the table
+    """
+    return {'delete_url': url_for(get_func_name(delete_func)),
+            'edit_url': url_for(get_func_name(edit_func)),
+            'csrf_token': generate_csrf()}
 
 
 @app.route('/items', methods=['GET'])
+@conditional_list(lambda: (models.ItemLot if config.INVENTORY_LOTS else models.Item).list_tables)
 def items():
+    # lots replace the individual items when lot inventory is on
+    item_model = models.ItemLot if config.INVENTORY_LOTS else models.Item
     return render_basic_table_view(request=request,
-                                   total=models.Item.total,
-                                   get_table_func=models.Item.get_list,
+                                   total=item_model.total,
+                                   get_table_func=item_model.get_list,
                                    record_name='Item',
-                                   html_path='view/items.html')
+                                   html_path='view/items.html',
+                                   export_func=export_items,
+                                   list_keys=item_model.list_keys)
 
 
 @app.route('/item-types', methods=['GET'])
+@conditional_list(lambda: models.ItemType.list_tables)
 def item_types():
     return render_basic_table_view(request=request,
                                    total=models.ItemType.total,
@@ -649,19 +758,25 @@ def item_types():
                                    record_name='Item Type',
                                    html_path='view/item-types.html',
                                    delete_func=delete_item_type,
-                                   edit_func=edit_item_type)
+                                   edit_func=edit_item_type,
+                                   export_func=export_item_types,
+                                   list_keys=models.ItemType.list_keys)
 
 
 @app.route('/item-stock', methods=['GET'])
+@conditional_list(lambda: models.Item.stock_tables)
 def item_stock():
     return render_basic_table_view(request=request,
                                    total=models.Item.total_item_stock,
                                    get_table_func=models.Item.get_stock_list,
                                    record_name='Item Type',
-                                   html_path='view/item-stock.html')
+                                   html_path='view/item-stock.html',
+                                   export_func=export_item_stock,
+                                   list_keys=models.Item.stock_keys)
 
 
 @app.route('/suppliers', methods=['GET'])
+@conditional_list(lambda: models.Supplier.list_tables)
 def suppliers():
     return render_basic_table_view(request=request,
                                    total=models.Supplier.total,
@@ -669,10 +784,13 @@ def suppliers():
                                    record_name='Supplier',
                                    html_path='view/suppliers.html',
                                    delete_func=delete_supplier,
-                                   edit_func=edit_supplier)
+                                   edit_func=edit_supplier,
+                                   export_func=export_suppliers,
+                                   list_keys=models.Supplier.list_keys)
 
 
 @app.route('/customers', methods=['GET'])
+@conditional_list(lambda: models.Customer.list_tables)
 def customers():
     return render_basic_table_view(request=request,
                                    total=models.Customer.total,
@@ -680,10 +798,13 @@ def customers():
                                    record_name='Customer',
                                    html_path='view/customers.html',
                                    delete_func=delete_customer,
-                                   edit_func=edit_customer)
+                                   edit_func=edit_customer,
+                                   export_func=export_customers,
+                                   list_keys=models.Customer.list_keys)
 
 
 @app.route('/couriers', methods=['GET'])
+@conditional_list(lambda: models.Courier.list_tables)
 def couriers():
     return render_basic_table_view(request=request,
                                    total=models.Courier.total,
@@ -691,10 +812,13 @@ def couriers():
                                    record_name='Courier',
                                    html_path='view/couriers.html',
                                    delete_func=delete_courier,
-                                   edit_func=edit_courier)
+                                   edit_func=edit_courier,
+                                   export_func=export_couriers,
+                                   list_keys=models.Courier.list_keys)
 
 
 @app.route('/transaction-mediums', methods=['GET'])
+@conditional_list(lambda: models.TransactionMedium.list_tables)
 def transaction_mediums():
     return render_basic_table_view(request=request,
                                    total=models.TransactionMedium.total,
@@ -702,33 +826,29 @@ def transaction_mediums():
                                    record_name='Transaction Medium',
                                    html_path='view/transaction-mediums.html',
                                    delete_func=delete_transaction_medium,
-                                   edit_func=edit_transaction_medium)
+                                   edit_func=edit_transaction_medium,
+                                   export_func=export_transaction_mediums,
+                                   list_keys=models.TransactionMedium.list_keys)
 
 
 @app.route('/purchase-transactions', methods=['GET', 'POST'])
 @app.route('/purchase-transactions/<trans_id>', methods=['GET', 'POST'])
+@conditional_list(lambda: models.PurchaseTransaction.list_tables)
 def purchase_transactions(trans_id=None):
+    filter_params = get_filter_params(request, trans_id)
     pagination_set = get_pagination(request=request,
-                                    total=models.PurchaseTransaction.total,
+                                    total=models.PurchaseTransaction.count(**filter_params),
                                     record_name='Transaction')
 
     form = forms.FilterTableForm()
 
-    if trans_id:
-        p_list = models.PurchaseTransaction \
-            .get_list(ids=trans_id,
-                      page_num=pagination_set.page_num,
-                      list_per_page=pagination_set.per_page)
-    else:
-        p_list = models.PurchaseTransaction \
-            .get_list(ids=request.args.getlist(config.URL_ID),
-                      year=request.args.getlist(config.URL_YEAR),
-                      month=request.args.getlist(config.URL_MONTH),
-                      day=request.args.getlist(config.URL_DAY),
-                      page_num=pagination_set.page_num,
-                      list_per_page=pagination_set.per_page)
+    p_list = models.PurchaseTransaction \
+        .get_list(page_num=pagination_set.page_num,
+                  list_per_page=pagination_set.per_page,
+                  cursor=pagination_set.cursor,
+                  **filter_params)
+    set_next_cursor(pagination_set, models.PurchaseTransaction.list_keys, p_list)
 
-    add_extra_column(p_list, delete_purchase_transaction, edit_purchase_transaction)
 
     # right now filter form is using POST to do query
     # the reason I didn't use GET is because the CSRF token is on (probably need to turn it off)
@@ -746,40 +866,39 @@ def purchase_transactions(trans_id=None):
             config.URL_ID: id_params if any(id_params) else None,
             config.URL_YEAR: year_params if any(year_params) else None,
             config.URL_MONTH: month_params if any(month_params) else None,
-            config.URL_DAY: day_params if any(day_params) else None
+            config.URL_DAY: day_params if any(day_params) else None,
+            config.URL_DATE_FROM: form.date_from.data.isoformat() if form.date_from.data else None,
+            config.URL_DATE_TO: form.date_to.data.isoformat() if form.date_to.data else None
         }
 
         return redirect(url_for('purchase_transactions', **params))
 
     return render_template('view/purchase-transactions.html', table=p_list, form=form,
+                           row_actions=get_row_actions(delete_purchase_transaction,
+                                                       edit_purchase_transaction),
                            pagination=pagination_set.pagination,
-                           per_page_form=pagination_set.per_page_form)
+                           per_page_form=pagination_set.per_page_form,
+                           export_url=get_export_url(export_purchase_transactions))
 
 
 @app.route('/sale-transactions', methods=['GET', 'POST'])
 @app.route('/sale-transactions/<sale_id>', methods=['GET', 'POST'])
+@conditional_list(lambda: models.SaleTransaction.list_tables)
 def sale_transactions(sale_id=None):
+    filter_params = get_filter_params(request, sale_id)
     pagination_set = get_pagination(request=request,
-                                    total=models.SaleTransaction.total,
+                                    total=models.SaleTransaction.count(**filter_params),
                                     record_name='Transaction')
 
     form = forms.FilterTableForm()
 
-    if sale_id:
-        s_list = models.SaleTransaction \
-            .get_list(ids=sale_id,
-                      page_num=pagination_set.page_num,
-                      list_per_page=pagination_set.per_page)
-    else:
-        s_list = models.SaleTransaction \
-            .get_list(ids=request.args.getlist(config.URL_ID),
-                      year=request.args.getlist(config.URL_YEAR),
-                      month=request.args.getlist(config.URL_MONTH),
-                      day=request.args.getlist(config.URL_DAY),
-                      page_num=pagination_set.page_num,
-                      list_per_page=pagination_set.per_page)
+    s_list = models.SaleTransaction \
+        .get_list(page_num=pagination_set.page_num,
+                  list_per_page=pagination_set.per_page,
+                  cursor=pagination_set.cursor,
+                  **filter_params)
+    set_next_cursor(pagination_set, models.SaleTransaction.list_keys, s_list)
 
-    add_extra_column(s_list, delete_sale_transaction, edit_sale_transaction)
 
     if form.validate_on_submit():
         id_params = utils.map_csv_params(form.id.data)
@@ -791,14 +910,19 @@ def sale_transactions(sale_id=None):
             config.URL_ID: id_params if any(id_params) else None,
             config.URL_YEAR: year_params if any(year_params) else None,
             config.URL_MONTH: month_params if any(month_params) else None,
-            config.URL_DAY: day_params if any(day_params) else None
+            config.URL_DAY: day_params if any(day_params) else None,
+            config.URL_DATE_FROM: form.date_from.data.isoformat() if form.date_from.data else None,
+            config.URL_DATE_TO: form.date_to.data.isoformat() if form.date_to.data else None
         }
 
         return redirect(url_for('sale_transactions', **params))
 
     return render_template('view/sale-transactions.html', table=s_list, form=form,
+                           row_actions=get_row_actions(delete_sale_transaction,
+                                                       edit_sale_transaction),
                            pagination=pagination_set.pagination,
-                           per_page_form=pagination_set.per_page_form)
+                           per_page_form=pagination_set.per_page_form,
+                           export_url=get_export_url(export_sale_transactions))
 
 
 # endregion
@@ -883,6 +1007,239 @@ def delete_sale_transaction():
     return view_delete(models.SaleTransaction, sale_transactions, request)
 
 
+# endregion
+
+# ----------
+# EXPORT Region
+# ----------
+
+# region export route
+
+def view_export(query, file_name):
+    """
+    Stream query result as csv file, rows are fetched in batches
+    (server side cursor where the database supports it) and written
+    out through a generator, so memory does not grow with the table
+    """
+    query = query.execution_options(stream_results=True) \
+        .yield_per(config.EXPORT_BATCH_SIZE)
+
+    def generate():
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(x['name'] for x in query.column_descriptions)
+
+        for row in query:
+            writer.writerow(row)
+            if buffer.tell() >= config.EXPORT_BUFFER_SIZE:
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+
+        yield buffer.getvalue()
+
+    return Response(stream_with_context(generate()), mimetype='text/csv',
+                    headers={'Content-Disposition':
+                             'attachment; filename={}.csv'.format(file_name)})
+
+
+@app.route('/items/export.csv', methods=['GET'])
+def export_items():
+    item_model = models.ItemLot if config.INVENTORY_LOTS else models.Item
+    return view_export(item_model.list_query(), 'items')
+
+
+@app.route('/item-types/export.csv', methods=['GET'])
+def export_item_types():
+    return view_export(models.ItemType.list_query(), 'item-types')
+
+
+@app.route('/item-stock/export.csv', methods=['GET'])
+def export_item_stock():
+    return view_export(models.Item.stock_query(), 'item-stock')
+
+
+@app.route('/suppliers/export.csv', methods=['GET'])
+def export_suppliers():
+    return view_export(models.Supplier.list_query(), 'suppliers')
+
+
+@app.route('/customers/export.csv', methods=['GET'])
+def export_customers():
+    return view_export(models.Customer.list_query(), 'customers')
+
+
+@app.route('/couriers/export.csv', methods=['GET'])
+def export_couriers():
+    return view_export(models.Courier.list_query(), 'couriers')
+
+
+@app.route('/transaction-mediums/export.csv', methods=['GET'])
+def export_transaction_mediums():
+    return view_export(models.TransactionMedium.list_query(), 'transaction-mediums')
+
+
+@app.route('/purchase-transactions/export.csv', methods=['GET'])
+def export_purchase_transactions():
+    return view_export(models.PurchaseTransaction.list_query(**get_filter_params(request)),
+                       'purchase-transactions')
+
+
+@app.route('/sale-transactions/export.csv', methods=['GET'])
+def export_sale_transactions():
+    return view_export(models.SaleTransaction.list_query(**get_filter_params(request)),
+                       'sale-transactions')
+
+
+# endregion
+
+# ----------
+# API Region
+# ----------
+
+# region api route
+
+def json_value(value):
+    # json.dumps default for the values of the list rows
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return float(value)
+    raise TypeError('{!r} is not JSON serializable'.format(value))
+
+
+def json_response(data, status=200):
+    return Response(json.dumps(data, default=json_value), status=status,
+                    mimetype='application/json')
+
+
+def view_api_list(get_table_func, total, list_keys, **filters):
+    """
+    Page of get_table_func as json, the rows are objects of the columns in
+    the fields param (every column by default), the footer row of the list
+    is returned as totals. next is the url of the next page which seeks
+    after the last row of this page
+    """
+    page = request.args.get(config.URL_PAGE_NUM)
+    page = int(page) if utils.is_int(page) else config.DEFAULT_PAGE_NUMBER
+
+    per_page = request.args.get(config.URL_PER_PAGE)
+    if per_page != config.ALL_IN_PAGE_KEYWORD:
+        per_page = int(per_page) if utils.is_int(per_page) else config.DEFAULT_POSTS_PER_PAGE
+
+    table = get_table_func(page_num=page,
+                           list_per_page=per_page,
+                           cursor=request.args.get(config.URL_CURSOR),
+                           **filters)
+
+    header = list(table[0])
+    rows = table[1:]
+    footer = rows.pop() if rows and rows[-1][0] in config.TABLE_FOOTER_KEYWORDS else None
+
+    fields = request.args.get(config.URL_FIELDS)
+    fields = utils.map_csv_params(fields) if fields else header
+    unknown = [x for x in fields if x not in header]
+    if unknown:
+        return json_response({'error': 'Unknown fields: {}'.format(', '.join(unknown)),
+                              'fields': header}, 400)
+    indexes = [header.index(x) for x in fields]
+
+    next_url = None
+    cursor = models.get_next_cursor(list_keys, table, page, per_page)
+    if cursor:
+        args = request.args.to_dict(flat=False)
+        args.update({config.URL_PAGE_NUM: page + 1, config.URL_CURSOR: cursor})
+        next_url = url_for(request.endpoint, **dict(request.view_args, **args))
+
+    return json_response({
+        'fields': fields,
+        'rows': [{x: row[i] for x, i in zip(fields, indexes)} for row in rows],
+        'totals': {x: footer[i] for x, i in zip(fields, indexes) if footer[i] != ''}
+        if footer else None,
+        'total': total,
+        'page': page,
+        'per_page': per_page,
+        'next': next_url
+    })
+
+
+@app.route('/api/items', methods=['GET'])
+@conditional_list(lambda: (models.ItemLot if config.INVENTORY_LOTS else models.Item).list_tables)
+def api_items():
+    item_model = models.ItemLot if config.INVENTORY_LOTS else models.Item
+    return view_api_list(item_model.get_list, item_model.total, item_model.list_keys)
+
+
+@app.route('/api/item-types', methods=['GET'])
+@conditional_list(lambda: models.ItemType.list_tables)
+def api_item_types():
+    return view_api_list(models.ItemType.get_list, models.ItemType.total,
+                         models.ItemType.list_keys)
+
+
+@app.route('/api/stock', methods=['GET'])
+@conditional_list(lambda: models.Item.stock_tables)
+def api_stock():
+    return view_api_list(models.Item.get_stock_list, models.Item.total_item_stock,
+                         models.Item.stock_keys)
+
+
+@app.route('/api/suppliers', methods=['GET'])
+@conditional_list(lambda: models.Supplier.list_tables)
+def api_suppliers():
+    return view_api_list(models.Supplier.get_list, models.Supplier.total,
+                         models.Supplier.list_keys)
+
+
+@app.route('/api/customers', methods=['GET'])
+@conditional_list(lambda: models.Customer.list_tables)
+def api_customers():
+    return view_api_list(models.Customer.get_list, models.Customer.total,
+                         models.Customer.list_keys)
+
+
+@app.route('/api/couriers', methods=['GET'])
+@conditional_list(lambda: models.Courier.list_tables)
+def api_couriers():
+    return view_api_list(models.Courier.get_list, models.Courier.total,
+                         models.Courier.list_keys)
+
+
+@app.route('/api/transaction-mediums', methods=['GET'])
+@conditional_list(lambda: models.TransactionMedium.list_tables)
+def api_transaction_mediums():
+    return view_api_list(models.TransactionMedium.get_list, models.TransactionMedium.total,
+                         models.TransactionMedium.list_keys)
+
+
+@app.route('/api/purchase-transactions', methods=['GET'])
+@app.route('/api/purchase-transactions/<trans_id>', methods=['GET'])
+@conditional_list(lambda: models.PurchaseTransaction.list_tables)
+def api_purchase_transactions(trans_id=None):
+    filter_params = get_filter_params(request, trans_id)
+    return view_api_list(models.PurchaseTransaction.get_list,
+                         models.PurchaseTransaction.count(**filter_params),
+                         models.PurchaseTransaction.list_keys,
+                         **filter_params)
+
+
+@app.route('/api/sale-transactions', methods=['GET'])
+@app.route('/api/sale-transactions/<sale_id>', methods=['GET'])
+@conditional_list(lambda: models.SaleTransaction.list_tables)
+def api_sale_transactions(sale_id=None):
+    filter_params = get_filter_params(request, sale_id)
+    return view_api_list(models.SaleTransaction.get_list,
+                         models.SaleTransaction.count(**filter_params),
+                         models.SaleTransaction.list_keys,
+                         **filter_params)
+
+
+@app.route('/api/metrics', methods=['GET'])
+def api_metrics():
+    # counters of this worker process since it started
+    return json_response({'writes': models.get_write_metrics()})
+
+
 # endregion
 
 # ----------
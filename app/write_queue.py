@@ -0,0 +1,182 @@
+"""
+Group commit of the model writes when WRITE_QUEUE is on in config.py,
+see models.write_transaction
+
+One writer thread runs the writes of every request thread in turn, so the
+writes never wait for each other's lock. Each write runs in its own
+savepoint (a failed write is rolled back alone, so a write must commit
+or roll back once, see models.write_transaction) and the writes are
+committed together, paying one commit (fsync, connection and cache version
+bumps) per group instead of one per write. A group takes every write
+submitted by then, up to WRITE_QUEUE_MAX_BATCH, and waits at most
+WRITE_QUEUE_MAX_DELAY seconds for the writes which are being submitted,
+it does not wait when no other write is on its way. The request thread
+waits for the result of its own write.
+`python manage.py benchmark_writes` compares it with committing every write
+"""
+import queue
+import threading
+import time
+from flask_sqlalchemy import SignallingSession
+from sqlalchemy import event, exc
+from app import app, db
+import config
+
+
+class WriteQueueError(Exception):
+    pass
+
+
+@event.listens_for(SignallingSession, 'after_commit')
+def record_group_commit(session):
+    # after_commit also fires when a savepoint is released
+    if 'group_committed' in session.info and not session.transaction.nested:
+        session.info['group_committed'] = True
+
+
+class Write(object):
+
+    def __init__(self, func):
+        self.func = func
+        self.result = None
+        self.exception = None
+        self.done = threading.Event()
+
+
+class WriteQueue(object):
+
+    def __init__(self, max_batch, max_delay, enabled=False):
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.enabled = enabled
+        self.writes = queue.Queue()
+        # writes submitted and not done yet, the writer only waits
+        # for more writes while some of them are not in its batch
+        self.submitted = 0
+        # group commits, for benchmark_writes
+        self.batches = 0
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def is_writer(self):
+        return threading.current_thread() is self.thread
+
+    def start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name='write-queue', daemon=True)
+                self.thread.start()
+
+    def submit(self, func):
+        """
+        Run func in the writer thread, wait and return its result,
+        a falsy result means the write failed and its changes are rolled back
+        """
+        self.start()
+        write = Write(func)
+        with self.lock:
+            self.submitted += 1
+        self.writes.put(write)
+        write.done.wait()
+
+        if write.exception is not None:
+            raise write.exception
+        return write.result
+
+    def run(self):
+        while True:
+            batch = [self.writes.get()]
+            deadline = time.time() + self.max_delay
+
+            while len(batch) < min(self.max_batch, self.submitted):
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self.writes.get(timeout=timeout))
+                except queue.Empty:
+                    break
+
+            try:
+                self.write_batch(batch)
+            finally:
+                with self.lock:
+                    self.submitted -= len(batch)
+                    self.batches += 1
+                for write in batch:
+                    write.done.set()
+
+    def write_batch(self, batch):
+        with app.app_context():
+            session = db.session()
+            # the writes join the group instead of beginning their own transaction
+            session.info['write_transaction'] = True
+            # writes in the open group transaction, and the ones
+            # committed or failed by a write which ended it
+            pending = []
+            ended = []
+            try:
+                self.begin(session)
+                for write in batch:
+                    group = session.transaction
+                    session.info['group_committed'] = False
+                    self.run_write(session, write)
+                    if session.transaction is group:
+                        pending.append(write)
+                        continue
+
+                    # the write committed or rolled back the group transaction
+                    # instead of its savepoint, the writes before it are
+                    # committed with it or lost with it
+                    failed = [write] if session.info['group_committed'] else pending + [write]
+                    error = WriteQueueError('write ended the group transaction, '
+                                            'it must commit or roll back once')
+                    for x in failed:
+                        if x.exception is None:
+                            x.exception = error
+                    ended += pending + [write]
+                    pending = []
+                    self.begin(session)
+
+                session.commit()
+            except Exception as e:
+                session.rollback()
+                # nothing of the open group is committed
+                for write in batch:
+                    if write not in ended and write.exception is None:
+                        write.exception = e
+            finally:
+                session.info.pop('write_transaction', None)
+                session.info.pop('group_committed', None)
+
+    def begin(self, session):
+        # other processes can still hold the lock, wait for them
+        deadline = time.time() + config.WRITE_RETRY_DEADLINE
+        while True:
+            try:
+                session.connection(execution_options={'sqlite_begin': 'IMMEDIATE'})
+                return
+            except exc.OperationalError:
+                session.rollback()
+                if time.time() >= deadline:
+                    raise
+                time.sleep(config.WRITE_RETRY_BASE_DELAY)
+
+    def run_write(self, session, write):
+        savepoint = session.begin_nested()
+        try:
+            write.result = write.func()
+        except Exception as e:
+            write.exception = e
+
+        # the write commits or rolls back its savepoint itself,
+        # close the savepoint if it is still open
+        if session.transaction is savepoint:
+            if write.result and write.exception is None:
+                session.commit()
+            else:
+                session.rollback()
+
+
+writer = WriteQueue(config.WRITE_QUEUE_MAX_BATCH, config.WRITE_QUEUE_MAX_DELAY,
+                    config.WRITE_QUEUE)
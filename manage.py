@@ -6,14 +6,601 @@
 # for help use
 # $ python manage.py db
 
-from flask_script import Manager
+from flask_script import Manager, Command, Option
 from flask_migrate import Migrate, MigrateCommand
-from app import db, app
+from flask_sqlalchemy import SignallingSession
+from app import db, app, models, importer, query_plans, result_cache, write_queue
+from app import check_sqlite_pragmas as app_check_sqlite_pragmas
+import config
+import functools
+from sqlalchemy import event
+from datetime import datetime
+import sys
+import tempfile
+import threading
+import time
 
 migrate = Migrate(app, db)
 
 manager = Manager(app)
 manager.add_command('db', MigrateCommand)
 
+# checks run by run_checks, in registration order
+checks = []
+
+
+def check_command(check):
+    """
+    Register a check returning the names of its failed cases,
+    both as its own command and as a part of run_checks
+    """
+    checks.append(check)
+
+    @functools.wraps(check)
+    def command():
+        db.create_all()
+        failed = check()
+        if failed:
+            print('Failed: {}'.format(', '.join(failed)))
+            sys.exit(1)
+
+    return manager.command(command)
+
+
+class ImportCommand(Command):
+    """
+    Import purchase and sale transactions from CSV or JSON lines files,
+    see app/importer.py for the record format
+    """
+    option_list = (
+        Option('paths', nargs='+', help='CSV or JSON lines files, imported in order'),
+        Option('--chunk-size', dest='chunk_size', type=int,
+               default=config.IMPORT_CHUNK_SIZE,
+               help='Number of transactions per commit'),
+    )
+
+    def run(self, paths, chunk_size):
+        # create the checkpoint table if it is not there yet
+        db.create_all()
+        file_importer = importer.Importer(chunk_size=chunk_size)
+        for path in paths:
+            file_importer.import_file(path)
+
+
+manager.add_command('import', ImportCommand())
+
+
+@manager.option('--purge', dest='purge', action='store_true', default=False,
+                help='Delete the Item rows after they are folded into lots')
+def fold_items_into_lots(purge=False):
+    """
+    Fold existing Item rows into ItemLot and LotAllocation rows,
+    set INVENTORY_LOTS = True in config.py afterwards
+    """
+    # create the lot tables if they are not there yet
+    db.create_all()
+    models.ItemLot.fold_items(purge)
+    print('Folded items into {} lots and {} allocations'.format(
+        models.ItemLot.total, models.LotAllocation.total))
+
+
+@manager.command
+def rebuild_item_type_stock():
+    """
+    Count the item type stock summary again from the items
+    """
+    db.create_all()
+    models.ItemTypeStock.refresh()
+    db.session.commit()
+    print('Rebuilt stock summary of {} item types'.format(models.ItemTypeStock.total))
+
+
+@manager.command
+def rebuild_transaction_lines():
+    """
+    Count the transaction lines of the list views again from the items
+    """
+    db.create_all()
+    models.TransactionLine.refresh()
+    db.session.commit()
+    print('Rebuilt {} transaction lines'.format(models.TransactionLine.total))
+
+
+@manager.command
+def create_indexes():
+    """
+    Create the model indexes missing from an existing database
+    """
+    db.create_all()
+    created = query_plans.create_missing_indexes()
+    print('Created {} indexes {}'.format(len(created), ', '.join(created)))
+
+
+@check_command
+def check_query_plans():
+    """
+    Print the query plan of the hot queries,
+    exit with status 1 if any of them scans a whole table
+    """
+    return query_plans.check_query_plans()
+
+
+@manager.command
+def run_checks():
+    """
+    Run every check command,
+    exit with status 1 if any of them fails
+    """
+    db.create_all()
+    failed = []
+    for check in checks:
+        print('== {}'.format(check.__name__))
+        failed.extend('{}: {}'.format(check.__name__, name) for name in check())
+    print('{} checks, {} failed'.format(len(checks), len(failed)))
+    if failed:
+        print('\n'.join(failed))
+        sys.exit(1)
+
+
+@manager.option('--rows', dest='rows', type=int, default=200,
+                help='Number of item types in the list')
+@manager.option('--requests', dest='requests', type=int, default=20,
+                help='Number of requests of every page size')
+def benchmark_list_render(rows=200, requests=20):
+    """
+    Time the item types list page with edit and delete buttons on every row
+    for growing page sizes, the time per row shows the cost of rendering
+    a row. It writes to the configured database, run it on a copy
+    """
+    db.create_all()
+
+    prefix = models.ItemType.format_item_type('Render Benchmark')
+    db.session.execute(models.ItemType.__table__.insert(),
+                       [{'item_type': '{}_{}'.format(prefix, i)} for i in range(rows)])
+    db.session.commit()
+
+    client = app.test_client()
+    try:
+        for per_page in sorted(set(x for x in (10, 50, rows) if x <= rows)):
+            url = '/item-types?{}={}'.format(config.URL_PER_PAGE, per_page)
+            if client.get(url).status_code != 200:
+                print('Failed to get {}'.format(url))
+                return
+
+            timings = []
+            for _ in range(requests):
+                started = time.time()
+                client.get(url)
+                timings.append(time.time() - started)
+
+            # the best run leaves out the one-off template compiling
+            best = min(timings)
+            print('{} rows: {:.1f}ms per page, {:.3f}ms per row'.format(
+                per_page, best * 1000, best * 1000 / per_page))
+    finally:
+        models.ItemType.query \
+            .filter(models.ItemType.item_type.startswith(prefix)) \
+            .delete(synchronize_session=False)
+        db.session.commit()
+
+
+@check_command
+def check_sqlite_pragmas():
+    """
+    Print the effective sqlite settings,
+    exit with status 1 if any of them differs from SQLITE_PRAGMAS
+    """
+    return app_check_sqlite_pragmas()
+
+
+@check_command
+def check_database():
+    """
+    Run the list, stock and sale allocation paths against the configured
+    database (e.g. PostgreSQL), exit with status 1 if one of them fails.
+    It adds and deletes its own records, point DATABASE_URL to a copy
+    """
+    name = 'Database Check'
+    failed = []
+
+    def check(step, ok, model=None):
+        print('{}: {}'.format('ok' if ok else 'FAILED', step))
+        if not ok:
+            if model is not None:
+                print('    {}'.format(model.error))
+            failed.append(step)
+        return ok
+
+    if not (check('add item type', models.ItemType.try_add(name), models.ItemType) and
+            check('add supplier', models.Supplier.try_add(name, '', ''), models.Supplier) and
+            check('add customer', models.Customer.try_add(name), models.Customer)):
+        return failed
+
+    item_type_id = models.ItemType.query \
+        .filter(models.ItemType.item_type == models.ItemType.format_item_type(name)).one().id
+    supplier_id = models.Supplier.query.filter(models.Supplier.name == name).one().id
+    customer_id = models.Customer.query.filter(models.Customer.name == name).one().id
+
+    try:
+        check('add purchase', models.PurchaseTransaction.try_add(
+            date=datetime.now(), supplier_id=supplier_id, notes=name,
+            transaction_items=[{'purchase_price': 10, 'item_type_id': item_type_id, 'quantity': 3}]),
+            models.PurchaseTransaction)
+        check('allocate sale', models.SaleTransaction.try_add(
+            date=datetime.now(), customer_id=customer_id, notes=name,
+            transaction_items=[{'sale_price': 15, 'item_type_id': item_type_id, 'quantity': 2}]),
+            models.SaleTransaction)
+        check('refuse sale over stock', not models.SaleTransaction.try_add(
+            date=datetime.now(), customer_id=customer_id, notes=name,
+            transaction_items=[{'sale_price': 15, 'item_type_id': item_type_id, 'quantity': 2}]))
+
+        stock = [x for x in models.Item.get_stock_list(list_per_page=config.ALL_IN_PAGE_KEYWORD)[1:]
+                 if x.item_type_id == item_type_id]
+        check('stock of the item type', [(x.stock_qty, x.sold_qty) for x in stock] == [(1, 2)])
+
+        item_model = models.ItemLot if config.INVENTORY_LOTS else models.Item
+        for model in (item_model, models.ItemType, models.Supplier, models.Customer,
+                      models.Courier, models.TransactionMedium,
+                      models.PurchaseTransaction, models.SaleTransaction):
+            check('{} list'.format(model.__name__),
+                  len(model.get_list()) > 1 or not model.total)
+
+        client = app.test_client()
+        for url in ('/items', '/item-types', '/item-stock', '/suppliers', '/customers',
+                    '/couriers', '/transaction-mediums', '/purchase-transactions',
+                    '/sale-transactions', '/api/stock', '/api/sale-transactions'):
+            check('GET {}'.format(url), client.get(url).status_code == 200)
+    finally:
+        # the item type delete also removes its purchases and sales
+        check('delete item type', models.ItemType.try_delete(item_type_id), models.ItemType)
+        check('delete customer', models.Customer.try_delete(customer_id), models.Customer)
+        check('delete supplier', models.Supplier.try_delete(supplier_id), models.Supplier)
+
+    return failed
+
+
+@check_command
+def check_transaction_views():
+    """
+    Edit and delete a purchase and a sale through the views,
+    exit with status 1 if one of them fails.
+    It adds and deletes its own records, point DATABASE_URL to a copy
+    """
+    name = 'Transaction Views Check'
+    date = datetime(2020, 1, 2, 3, 4, 5)
+    models.ItemType.try_add(name)
+    models.Supplier.try_add(name, '', '')
+    models.Customer.try_add(name)
+    item_type_id = models.ItemType.query \
+        .filter(models.ItemType.item_type == models.ItemType.format_item_type(name)).one().id
+    supplier_id = models.Supplier.query.filter(models.Supplier.name == name).one().id
+    customer_id = models.Customer.query.filter(models.Customer.name == name).one().id
+
+    models.PurchaseTransaction.try_add(
+        date=date, supplier_id=supplier_id, notes=name,
+        transaction_items=[{'purchase_price': 10, 'item_type_id': item_type_id, 'quantity': 3}])
+    models.SaleTransaction.try_add(
+        date=date, customer_id=customer_id, notes=name,
+        transaction_items=[{'sale_price': 15, 'item_type_id': item_type_id, 'quantity': 1}])
+    purchase_id = models.PurchaseTransaction.query \
+        .filter(models.PurchaseTransaction.supplier_id == supplier_id).one().id
+    sale_id = models.SaleTransaction.query \
+        .filter(models.SaleTransaction.customer_id == customer_id).one().id
+    db.session.commit()
+
+    date_fields = {'yyyy': date.year, 'MM': date.month, 'dd': date.day,
+                   'HH': date.hour, 'mm': date.minute, 'ss': date.second}
+    # the edit views take the id from the url and the delete views from
+    # the form, both as strings
+    steps = [('edit purchase', models.PurchaseTransaction, purchase_id,
+              '/purchase-transactions/edit/{}'.format(purchase_id),
+              dict(date_fields, supplier_id=supplier_id, notes='edited',
+                   **{'transaction_items-0-ids': '',
+                      'transaction_items-0-purchase_price': 11,
+                      'transaction_items-0-item_type': item_type_id,
+                      'transaction_items-0-quantity': 3})),
+             ('edit sale', models.SaleTransaction, sale_id,
+              '/sale-transactions/edit/{}'.format(sale_id),
+              dict(date_fields, customer_id=customer_id, notes='edited',
+                   courier_id=config.NULL_INTEGER, transaction_medium_id=config.NULL_INTEGER,
+                   **{'transaction_items-0-sale_price': 16,
+                      'transaction_items-0-item_stock': item_type_id,
+                      'transaction_items-0-quantity': 1})),
+             ('delete sale', models.SaleTransaction, sale_id,
+              '/sale-transactions/delete', {config.URL_ID: str(sale_id)}),
+             ('delete purchase', models.PurchaseTransaction, purchase_id,
+              '/purchase-transactions/delete', {config.URL_ID: str(purchase_id)})]
+
+    def line_count(model, id):
+        return models.TransactionLine.query \
+            .filter(models.TransactionLine.is_sale == (model is models.SaleTransaction),
+                    models.TransactionLine.transaction_id == id).count()
+
+    failed = []
+    csrf_enabled = app.config.get('WTF_CSRF_ENABLED', True)
+    app.config['WTF_CSRF_ENABLED'] = False
+    client = app.test_client()
+    try:
+        for step, model, id, url, data in steps:
+            client.post(url, data=data)
+            db.session.rollback()
+            transaction = model.get(id)
+            if step.startswith('edit'):
+                ok = transaction is not None and transaction.notes == 'edited' and line_count(model, id)
+            else:
+                ok = transaction is None and not line_count(model, id)
+
+            print('{}: {}'.format('ok' if ok else 'FAILED', step))
+            if not ok:
+                failed.append(step)
+    finally:
+        app.config['WTF_CSRF_ENABLED'] = csrf_enabled
+        # the item type delete also removes the transactions left by a failed step
+        models.ItemType.try_delete(item_type_id)
+        models.Customer.try_delete(customer_id)
+        models.Supplier.try_delete(supplier_id)
+
+    return failed
+
+
+@check_command
+def check_request_errors():
+    """
+    Fail a write in one thread while another thread writes successfully,
+    exit with status 1 if the error of one is seen by the other
+    """
+    name = 'Request Errors Check'
+    models.ItemType.try_add(name)
+
+    failed_added = threading.Event()
+    results = {}
+
+    def failing_request():
+        with app.app_context():
+            # the item type exists already
+            models.ItemType.try_add(name)
+            results['failing'] = models.ItemType.error
+            failed_added.set()
+
+    def other_request():
+        with app.app_context():
+            failed_added.wait(10)
+            results['other'] = models.ItemType.error
+
+    workers = [threading.Thread(target=failing_request), threading.Thread(target=other_request)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    models.ItemType.query \
+        .filter(models.ItemType.item_type == models.ItemType.format_item_type(name)) \
+        .delete(synchronize_session=False)
+    db.session.commit()
+
+    print('failing request error: {}'.format(results.get('failing')))
+    print('other request error: {}'.format(results.get('other')))
+
+    failed = []
+    if results.get('failing') is None:
+        failed.append('failing request')
+    if results.get('other') is not None:
+        failed.append('other request')
+    return failed
+
+
+@check_command
+def check_write_queue():
+    """
+    Run one batch of writes through the write queue (WRITE_QUEUE) where one
+    write fails, exit with status 1 if the other writes are not committed
+    together. It adds and deletes its own records, point DATABASE_URL to a copy
+    """
+    name = 'Write Queue Check'
+    prefix = models.ItemType.format_item_type(name)
+
+    # an item type with a purchase and a sale, its delete runs several statements
+    models.ItemType.try_add(name)
+    models.Supplier.try_add(name, '', '')
+    models.Customer.try_add(name)
+    item_type_id = models.ItemType.query.filter(models.ItemType.item_type == prefix).one().id
+    supplier_id = models.Supplier.query.filter(models.Supplier.name == name).one().id
+    customer_id = models.Customer.query.filter(models.Customer.name == name).one().id
+    models.PurchaseTransaction.try_add(
+        date=datetime.now(), supplier_id=supplier_id, notes=name,
+        transaction_items=[{'purchase_price': 10, 'item_type_id': item_type_id, 'quantity': 2}])
+    models.SaleTransaction.try_add(
+        date=datetime.now(), customer_id=customer_id, notes=name,
+        transaction_items=[{'sale_price': 15, 'item_type_id': item_type_id, 'quantity': 1}])
+    db.session.commit()
+
+    names = ['{} {}'.format(name, i) for i in range(4)]
+    writes = [('delete item type', lambda: models.ItemType.try_delete(item_type_id))]
+    writes += [('add ' + x, lambda x=x: models.ItemType.try_add(x)) for x in names]
+    # the item type exists already
+    writes.insert(2, ('add duplicate', lambda: models.ItemType.try_add(names[0])))
+
+    results = {}
+
+    def write(step, func):
+        with app.app_context():
+            results[step] = (func(), models.ItemType.error)
+
+    commits = []
+
+    # commits of the writer's session, not the version bumps after them
+    def count_commit(session):
+        if not session.transaction.nested:
+            commits.append(session)
+
+    event.listen(SignallingSession, 'after_commit', count_commit)
+    write_queue.writer.enabled = True
+    max_batch, max_delay = write_queue.writer.max_batch, write_queue.writer.max_delay
+    # wait long enough for every write to join the same batch, the writes
+    # count as submitted before their threads start so the writer waits for them
+    write_queue.writer.max_batch, write_queue.writer.max_delay = len(writes), 1.0
+    with write_queue.writer.lock:
+        write_queue.writer.submitted += len(writes)
+    try:
+        workers = [threading.Thread(target=write, args=x) for x in writes]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+    finally:
+        write_queue.writer.enabled = config.WRITE_QUEUE
+        write_queue.writer.max_batch, write_queue.writer.max_delay = max_batch, max_delay
+        with write_queue.writer.lock:
+            write_queue.writer.submitted -= len(writes)
+        event.remove(SignallingSession, 'after_commit', count_commit)
+
+    db.session.rollback()
+    added = models.ItemType.query \
+        .filter(models.ItemType.item_type.startswith(prefix + '_')).count()
+    left = models.PurchaseTransaction.query \
+        .filter(models.PurchaseTransaction.notes == name).count() + \
+        models.SaleTransaction.query.filter(models.SaleTransaction.notes == name).count()
+
+    for step, func in writes:
+        result, error = results.get(step, (None, None))
+        print('{}: {}'.format(step, 'committed' if result else 'failed ({})'.format(error)))
+    print('{} group commits, {} item types added, {} transactions left'.format(
+        len(commits), added, left))
+
+    # the delete in the batch removed the purchase and sale unless it failed
+    if models.ItemType.get(item_type_id) is not None:
+        models.ItemType.try_delete(item_type_id)
+    models.ItemType.query \
+        .filter(models.ItemType.item_type.startswith(prefix + '_')) \
+        .delete(synchronize_session=False)
+    db.session.commit()
+    models.Customer.try_delete(customer_id)
+    models.Supplier.try_delete(supplier_id)
+
+    failed = []
+    if len(commits) != 1:
+        failed.append('one group commit')
+    if added != len(names) or left:
+        failed.append('batch writes committed')
+    # exactly one of the two adds of the same name fails
+    failed_steps = [step for step, func in writes if not results.get(step, (None, None))[0]]
+    if len(failed_steps) != 1 or failed_steps[0] not in ('add duplicate', 'add ' + names[0]):
+        failed.append('failed write')
+    return failed
+
+
+@manager.command
+def clear_list_cache():
+    """
+    Remove every entry of the list view result cache directory (LIST_CACHE_DIR)
+    """
+    if not config.LIST_CACHE_DIR:
+        print('LIST_CACHE_DIR is not set')
+        return
+    result_cache.FileCache(config.LIST_CACHE_DIR).clear()
+    print('Cleared {}'.format(config.LIST_CACHE_DIR))
+
+
+@check_command
+def check_list_cache():
+    """
+    Store the first page of every list in a file cache and read it back,
+    exit with status 1 if a list is not read back the same
+    """
+    item_model = models.ItemLot if config.INVENTORY_LOTS else models.Item
+    lists = [(model.__name__, model.get_list)
+             for model in (item_model, models.ItemType, models.Supplier, models.Customer,
+                           models.Courier, models.TransactionMedium,
+                           models.PurchaseTransaction, models.SaleTransaction)]
+    lists.append(('Stock', models.Item.get_stock_list))
+
+    failed = []
+    with tempfile.TemporaryDirectory() as directory:
+        for name, get_list in lists:
+            table = get_list()
+            result_cache.FileCache(directory).set(name, table)
+            # a new cache reads the file, not an object kept in memory
+            cached = result_cache.FileCache(directory).get(name)
+
+            same = cached == table and \
+                list(map(repr, cached[0].types)) == list(map(repr, table[0].types))
+            print('{}: {} ({} rows)'.format('ok' if same else 'DIFFERENT', name, len(table) - 1))
+            if not same:
+                failed.append(name)
+
+    return failed
+
+
+@check_command
+def check_list_etags():
+    """
+    Get every list page with a new client and again with its etag,
+    exit with status 1 if the second request is not answered with 304
+    """
+    failed = []
+    for url in ('/items', '/item-types', '/item-stock', '/suppliers', '/customers',
+                '/couriers', '/transaction-mediums', '/purchase-transactions',
+                '/sale-transactions'):
+        # a new client has a new session, like the first visit of a browser
+        client = app.test_client()
+        etag, _ = client.get(url).get_etag()
+        status = client.get(url, headers={'If-None-Match': '"{}"'.format(etag)}).status_code
+        print('{}: {} ({})'.format('ok' if status == 304 else 'FAILED', url, status))
+        if status != 304:
+            failed.append(url)
+
+    return failed
+
+
+@manager.option('--writes', dest='writes', type=int, default=1000,
+                help='Number of writes in every mode')
+@manager.option('--threads', dest='threads', type=int, default=8,
+                help='Number of concurrent writers')
+def benchmark_writes(writes=1000, threads=8):
+    """
+    Compare write throughput of committing every write with the group commit
+    write queue (WRITE_QUEUE), by adding and deleting item types from concurrent
+    threads. It writes to the configured database, point DATABASE_URL to a copy
+    """
+    db.create_all()
+
+    def write_all(names):
+        with app.app_context():
+            for name in names:
+                if not models.ItemType.try_add(name):
+                    print('Failed to add {}: {}'.format(name, models.ItemType.error))
+
+    for mode, use_queue in (('commit per write', False), ('write queue', True)):
+        write_queue.writer.enabled = use_queue
+        prefix = 'Write Benchmark {}'.format(int(use_queue))
+        names = ['{} {}'.format(prefix, i) for i in range(writes)]
+        before = models.get_write_metrics()
+        batches = write_queue.writer.batches
+
+        started = time.time()
+        workers = [threading.Thread(target=write_all, args=(names[i::threads],))
+                   for i in range(threads)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        elapsed = max(time.time() - started, 1e-6)
+
+        after = models.get_write_metrics()
+        commits = write_queue.writer.batches - batches if use_queue else writes
+        print('{}: {} writes in {:.2f}s, {:,.0f} writes/s, {:.1f} writes per commit, '
+              '{} retries, {} busy failures'.format(
+                  mode, writes, elapsed, writes / elapsed, writes / max(commits, 1),
+                  after['retries'] - before['retries'],
+                  after['busy_failures'] - before['busy_failures']))
+
+        models.ItemType.query \
+            .filter(models.ItemType.item_type.startswith(models.ItemType.format_item_type(prefix))) \
+            .delete(synchronize_session=False)
+        db.session.commit()
+
+    write_queue.writer.enabled = config.WRITE_QUEUE
+
+
 if __name__ == '__main__':
     manager.run()
@@ -1,3 +1,7 @@
 #!flask/bin/python
-from app import app
-app.run(host='0.0.0.0', debug=True)
\ No newline at end of file
+from app import app, check_sqlite_pragmas
+
+# report the effective database settings on startup
+check_sqlite_pragmas()
+# every request runs in its own thread, model errors are kept per request
+app.run(host='0.0.0.0', debug=True, threaded=True)
\ No newline at end of file